@@ -0,0 +1,46 @@
+import numpy as np
+from process_signs import _flip_horizontally, _flip_vertically, _rotate_180, _rotate_arrows, aug_seq, rotate
+
+
+def _build_transforms(number_of_classes):
+    """For every class a list of (method, new class) - the symmetric variants of its images."""
+    transforms = [[] for _ in range(number_of_classes)]
+
+    for list_of_pairs, method in [(_flip_horizontally, np.fliplr), (_flip_vertically, np.flipud),
+                                  (_rotate_180, lambda image: np.rot90(image, 2))]:
+        for first, second in list_of_pairs:
+            transforms[first].append((method, second))
+            if first != second:
+                transforms[second].append((method, first))
+
+    for first_cat, first_angle in _rotate_arrows:
+        for second_cat, second_angle in _rotate_arrows:
+            if first_cat != second_cat:
+                transforms[first_cat].append((lambda image, angle=first_angle - second_angle: rotate(image, angle),
+                                              second_cat))
+
+    return transforms
+
+
+_transforms = _build_transforms(93)
+
+
+def augment_batch(images, labels, random_state, use_aug_seq=True):
+    """Augments a batch of uint8 images, each image is replaced by one of its symmetric variants (or kept as it is)
+    and then passed through aug_seq. The result only depends on the state of random_state."""
+    images = np.array(images)
+    labels = np.array(labels)
+
+    for i in range(len(images)):
+        options = _transforms[labels[i]]
+        choice = random_state.randint(len(options) + 1)
+        if choice < len(options):
+            method, labels[i] = options[choice]
+            images[i] = method(images[i])
+
+    if use_aug_seq:
+        seq = aug_seq.deepcopy()
+        seq.reseed(random_state.randint(2 ** 31))
+        images = np.stack(seq.augment_images(list(images)), axis=0)
+
+    return images, labels
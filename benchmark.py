@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import tempfile
+import time
+from PIL import Image, ImageDraw
+import numpy as np
+
+_NUMBER_OF_CLASSES = 93
+
+
+def make_synthetic_dataset(path, images_per_class=20, seed=123):
+    """Creates a data folder of random sign-like images with the same data/000NN layout as merge_datasets.py."""
+    random_state = np.random.RandomState(seed)
+
+    for c in range(_NUMBER_OF_CLASSES):
+        dir_name = path + '/' + format(c, '05d')
+        os.makedirs(dir_name, exist_ok=True)
+
+        for i in range(images_per_class):
+            size = int(random_state.randint(24, 128))
+            background = tuple(int(v) for v in random_state.randint(0, 256, 3))
+            img = Image.new('RGB', (size, size), background)
+            draw = ImageDraw.Draw(img)
+
+            color = ((c * 37) % 256, (c * 91) % 256, (c * 53) % 256)
+            margin = size // 8
+            if c % 3 == 0:
+                draw.ellipse((margin, margin, size - margin, size - margin), fill=color)
+            elif c % 3 == 1:
+                draw.polygon([(size // 2, margin), (size - margin, size - margin), (margin, size - margin)], fill=color)
+            else:
+                draw.rectangle((margin, margin, size - margin, size - margin), fill=color)
+
+            noise = random_state.randint(-20, 21, (size, size, 3))
+            image = np.clip(np.array(img, dtype=np.int32) + noise, 0, 255).astype(np.uint8)
+            Image.fromarray(image).save(dir_name + '/' + format(i, '05d') + '.jpg', 'JPEG')
+
+
+def timed(method, repeats=3):
+    """Returns the best time of repeats runs and the result of the last one."""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = method()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def run_benchmarks(path, input_shape=(32, 32), batch_size=64, repeats=3):
+    from packed_dataset import list_class_files
+    from train import build_model, list_of_lists_to_numpy_array_images_and_labels
+    import preprocessing
+
+    results = {}
+
+    def record(name, seconds, images):
+        throughput = images / seconds if seconds else None
+        results[name] = {'seconds': seconds, 'images_per_second': throughput}
+        print(f'{name}: {seconds:.4f} s, ' + (f'{throughput:.1f} images/s' if throughput else 'too fast to measure'))
+
+    files = list_class_files(path)
+    all_files = [f for class_files in files for f in class_files]
+
+    def decode():
+        decoded = []
+        for f in all_files:
+            with Image.open(f) as img:
+                decoded.append(np.array(img))
+        return decoded
+
+    seconds, decoded = timed(decode, repeats)
+    record('jpeg_decode', seconds, len(all_files))
+
+    seconds, resized = timed(lambda: preprocessing.resize(decoded, input_shape), repeats)
+    record('resize', seconds, len(resized))
+
+    seconds, _ = timed(lambda: preprocessing.image_histogram_equalization(resized), repeats)
+    record('histogram_equalization', seconds, len(resized))
+
+    offsets = np.cumsum([0] + [len(f) for f in files])
+    per_class = [list(resized[offsets[c]:offsets[c + 1]]) for c in range(_NUMBER_OF_CLASSES)]
+    seconds, (images, labels) = timed(lambda: list_of_lists_to_numpy_array_images_and_labels(per_class), repeats)
+    record('batch_assembly', seconds, len(images))
+
+    images = preprocessing.preprocess(images, input_shape)
+    labels = np.array(labels)
+    model = build_model(input_shape + (3,))
+    model.fit(images[:batch_size], labels[:batch_size], batch_size=batch_size, epochs=1, verbose=0)
+
+    seconds, _ = timed(lambda: model.fit(images, labels, batch_size=batch_size, epochs=1, verbose=0), repeats)
+    record('fit_epoch', seconds, len(images))
+
+    single = images[:1]
+    seconds, _ = timed(lambda: [model.predict(single) for _ in range(100)], repeats)
+    record('predict_single', seconds / 100, 1)
+
+    batch = images[:256]
+    seconds, _ = timed(lambda: model.predict(batch, batch_size=len(batch)), repeats)
+    record('predict_batch', seconds, len(batch))
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns the names of the benchmarks which are more than tolerance slower than the baseline."""
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline or not baseline[name]['seconds']:
+            continue
+
+        ratio = result['seconds'] / baseline[name]['seconds']
+        regressed = ratio > 1 + tolerance
+        print(f'{name}: {ratio:.2f}x of baseline' + (' REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(name)
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', help='data folder to benchmark on, a synthetic one is generated by default')
+    parser.add_argument('--images-per-class', type=int, default=20, help='size of the synthetic data set')
+    parser.add_argument('--repeats', type=int, default=3, help='number of runs of every benchmark, the best is kept')
+    parser.add_argument('--output', default='benchmark.json', help='results file')
+    parser.add_argument('--baseline', help='results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    # read the baseline first, it may be the same file as the output
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if args.data:
+        results = run_benchmarks(args.data, repeats=args.repeats)
+    else:
+        with tempfile.TemporaryDirectory() as path:
+            print('Generating synthetic data set')
+            make_synthetic_dataset(path, args.images_per_class)
+            results = run_benchmarks(path, repeats=args.repeats)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+
+        if regressions:
+            print('Regressions:', ', '.join(regressions))
+            exit(1)
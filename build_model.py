@@ -31,14 +31,17 @@ def build_model(input_shape, conv_depth, dense_depth, optimizer, loss):
     return model
 
 
+def model_configurations():
+    return [(conv_depth, dense_depth) for conv_depth in range(1, 5) for dense_depth in range(1, 5)]
+
+
 def build_models():
     models = []
 
-    for conv_depth in range(1, 5):
-        for dense_depth in range(1, 5):
-            model = build_model((32, 32, 3), conv_depth, dense_depth, keras.optimizers.Adam(),
-                                keras.losses.categorical_crossentropy)
-            models.append(model)
+    for conv_depth, dense_depth in model_configurations():
+        model = build_model((32, 32, 3), conv_depth, dense_depth, keras.optimizers.Adam(),
+                            keras.losses.categorical_crossentropy)
+        models.append(model)
 
     return models
 
@@ -0,0 +1,97 @@
+import json
+import os
+import pickle
+import random as rnd
+import shutil
+import time
+import numpy as np
+from tensorflow import keras
+
+# a checkpoint is a directory named ckpt-<global step> with the files:
+#   model.h5   - model with its weights and optimizer state
+#   state.json - epoch, step within the epoch and global step
+#   rng.pkl    - state of the python and numpy random generators
+#   splits.npz - indices of the test, validation and training images
+_PREFIX = 'ckpt-'
+
+
+def list_checkpoints(checkpoint_dir):
+    if not os.path.isdir(checkpoint_dir):
+        return []
+
+    return sorted(os.path.join(checkpoint_dir, d) for d in os.listdir(checkpoint_dir)
+                  if d.startswith(_PREFIX) and not d.endswith('.tmp'))
+
+
+def latest_checkpoint(checkpoint_dir):
+    checkpoints = list_checkpoints(checkpoint_dir)
+    return checkpoints[-1] if checkpoints else None
+
+
+def load_checkpoint(checkpoint, custom_objects=None):
+    """Returns the model, the training state and the splits, restores the random generators."""
+    model = keras.models.load_model(os.path.join(checkpoint, 'model.h5'), custom_objects=custom_objects)
+
+    with open(os.path.join(checkpoint, 'state.json')) as f:
+        state = json.load(f)
+
+    with open(os.path.join(checkpoint, 'rng.pkl'), 'rb') as f:
+        python_state, numpy_state = pickle.load(f)
+    rnd.setstate(python_state)
+    np.random.set_state(numpy_state)
+
+    splits = np.load(os.path.join(checkpoint, 'splits.npz'))
+    return model, state, [splits[f'split_{i}'] for i in range(len(splits.files))]
+
+
+class PeriodicCheckpoint(keras.callbacks.Callback):
+    """Saves a checkpoint every `steps` batches and/or every `minutes` minutes and at the end of every epoch,
+    only the newest `keep` checkpoints are kept."""
+
+    def __init__(self, checkpoint_dir, splits, steps=None, minutes=None, keep=3, initial_step=0, step_offset=0):
+        super().__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.splits = splits
+        self.steps = steps
+        self.seconds = minutes * 60 if minutes else None
+        self.keep = keep
+        self.global_step = initial_step
+        self.step_offset = step_offset
+        self.epoch = 0
+        self.last_save = time.monotonic()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        self.global_step += 1
+
+        due = self.steps and self.global_step % self.steps == 0
+        due = due or (self.seconds and time.monotonic() - self.last_save >= self.seconds)
+        if due:
+            self.save(self.epoch, self.step_offset + batch + 1)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.step_offset = 0
+        self.save(epoch + 1, 0)
+
+    def save(self, epoch, step):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        checkpoint = os.path.join(self.checkpoint_dir, _PREFIX + format(self.global_step, '09d'))
+        tmp = checkpoint + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        self.model.save(os.path.join(tmp, 'model.h5'))
+        with open(os.path.join(tmp, 'state.json'), 'w') as f:
+            json.dump({'epoch': epoch, 'step': step, 'global_step': self.global_step}, f)
+        with open(os.path.join(tmp, 'rng.pkl'), 'wb') as f:
+            pickle.dump((rnd.getstate(), np.random.get_state()), f)
+        np.savez(os.path.join(tmp, 'splits.npz'), **{f'split_{i}': s for i, s in enumerate(self.splits)})
+
+        shutil.rmtree(checkpoint, ignore_errors=True)
+        os.replace(tmp, checkpoint)
+        self.last_save = time.monotonic()
+
+        for old in list_checkpoints(self.checkpoint_dir)[:-self.keep]:
+            shutil.rmtree(old, ignore_errors=True)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import argparse
+import gzip
+import os
+import numpy as np
+from tensorflow import keras
+from export_tflite import measure
+import input_pipeline
+from packed_dataset import load_groups
+import preprocessing
+from splits import check_splits, load_or_create_splits
+from train import load_images
+
+
+def prunable_layers(model):
+    """Names of the convolutions and of the dense layers except the last one, whose outputs are the classes."""
+    layers = [layer for layer in model.layers if isinstance(layer, (keras.layers.Conv2D, keras.layers.Dense))]
+    return [layer.name for layer in layers[:-1]]
+
+
+def select_units(model, sparsities):
+    """For every layer in sparsities the indices of the filters or units with the largest L1 norm of their
+    weights, keeping 1 - sparsity of them."""
+    keep = {}
+    for name, sparsity in sparsities.items():
+        kernel = model.get_layer(name).get_weights()[0]
+        norms = np.abs(kernel).reshape(-1, kernel.shape[-1]).sum(axis=0)
+        n = max(1, int(round(kernel.shape[-1] * (1 - sparsity))))
+        keep[name] = np.sort(np.argsort(norms)[::-1][:n])
+    return keep
+
+
+def prune(model, keep):
+    """Rebuilds a Sequential model with only the kept filters and units of the layers in keep, the inputs of the
+    following layers are sliced to match, so the pruned model is physically smaller."""
+    pruned = keras.models.Sequential(name=model.name)
+    channels = None  # kept channels of the output of the previous layer, None for all
+
+    for layer in model.layers:
+        config = layer.get_config()
+        weights = layer.get_weights()
+
+        if isinstance(layer, keras.layers.Flatten) and channels is not None:
+            # the inputs of the next dense layer are the flattened (height, width, channels) feature map
+            shape = layer.input_shape[1:]
+            channels = np.arange(np.prod(shape)).reshape(shape)[..., channels].ravel()
+        elif isinstance(layer, (keras.layers.Conv2D, keras.layers.Dense)):
+            kernel, rest = weights[0], weights[1:]
+            if channels is not None:
+                kernel = np.take(kernel, channels, axis=-2)
+
+            channels = keep.get(layer.name)
+            if channels is not None:
+                kernel = kernel[..., channels]
+                rest = [w[channels] for w in rest]
+                config['filters' if isinstance(layer, keras.layers.Conv2D) else 'units'] = len(channels)
+            weights = [kernel] + rest
+
+        copy = type(layer).from_config(config)
+        pruned.add(copy)
+        copy.set_weights(weights)
+
+    return pruned
+
+
+def cluster_weights(model, layers, clusters=16, iterations=20):
+    """Replaces the kernel values of every layer by the nearest of `clusters` shared values found by k-means, the
+    model keeps its size but compresses much better."""
+    for name in layers:
+        layer = model.get_layer(name)
+        kernel, rest = layer.get_weights()[0], layer.get_weights()[1:]
+        values = kernel.ravel()
+
+        centroids = np.linspace(values.min(), values.max(), clusters, dtype=values.dtype)
+        for _ in range(iterations):
+            # centroids are sorted, so the nearest one is found by the midpoints between them
+            assignment = np.searchsorted((centroids[1:] + centroids[:-1]) / 2, values)
+            sums = np.bincount(assignment, weights=values, minlength=clusters)
+            counts = np.bincount(assignment, minlength=clusters)
+            centroids = np.where(counts > 0, sums / np.maximum(counts, 1), centroids).astype(values.dtype)
+            centroids.sort()
+
+        assignment = np.searchsorted((centroids[1:] + centroids[:-1]) / 2, values)
+        layer.set_weights([centroids[assignment].reshape(kernel.shape)] + rest)
+
+
+def gzip_size(file):
+    with open(file, 'rb') as f:
+        return len(gzip.compress(f.read()))
+
+
+def report(name, model, file, images, labels):
+    latency, accuracy = measure(model, images, labels)
+    print(f'{name}: {model.count_params()} parameters, {os.path.getsize(file)} B ({gzip_size(file)} B gzipped), '
+          f'{latency:.3f} ms per image, accuracy {accuracy:.4f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='prunes whole filters and units of a trained model, fine-tunes it '
+                                                 'and saves the smaller model')
+    parser.add_argument('model', help='trained keras model')
+    parser.add_argument('output', help='name of the compressed .h5 file')
+    parser.add_argument('path', help='data folder or packed data set the model was trained on')
+    parser.add_argument('--equalize', action='store_true', help='the model was trained with histogram equalization')
+    parser.add_argument('--group-tracks', action='store_true', help='the model was trained with --group-tracks')
+    parser.add_argument('--dense-sparsity', type=float, default=0.75,
+                        help='fraction of the units of the hidden dense layers removed')
+    parser.add_argument('--conv-sparsity', type=float, default=0.25, help='fraction of the conv filters removed')
+    parser.add_argument('--layers', help='comma separated names of the pruned layers, all hidden layers by default')
+    parser.add_argument('--epochs', type=int, default=2, help='epochs of fine-tuning after the pruning')
+    parser.add_argument('--clusters', type=int, default=0,
+                        help='cluster the weights of the pruned layers into this many shared values after '
+                             'the fine-tuning')
+    args = parser.parse_args()
+
+    model = keras.models.load_model(args.model)
+    input_shape = tuple(model.input_shape[2:0:-1])
+    grayscale = model.input_shape[3] == 1
+    batch_size = 64
+
+    # the same data set and splits as train.py, the model is evaluated on its test split
+    images, labels = load_images(args.path, input_shape, grayscale, args.equalize, False)
+    groups = load_groups(args.path) if args.group_tracks else None
+    test_indices, validation_indices, train_indices = load_or_create_splits(args.path, labels,
+                                                                             (0.1, 0.1 * (1 - 0.1)), groups)
+    check_splits(test=len(test_indices), validation=len(validation_indices), training=len(train_indices))
+    test_images = preprocessing.normalize(images[test_indices])
+    validation_images = preprocessing.normalize(images[validation_indices])
+    test_labels, validation_labels = labels[test_indices], labels[validation_indices]
+
+    report('Original', model, args.model, test_images, test_labels)
+
+    layers = args.layers.split(',') if args.layers else prunable_layers(model)
+    sparsities = {name: args.conv_sparsity if isinstance(model.get_layer(name), keras.layers.Conv2D)
+                  else args.dense_sparsity for name in layers}
+    pruned = prune(model, select_units(model, sparsities))
+    pruned.compile(optimizer=keras.optimizers.Adam(1e-4), loss=keras.losses.sparse_categorical_crossentropy,
+                   metrics=['sparse_categorical_accuracy'])
+
+    print('Pruned accuracy before fine-tuning:', measure(pruned, test_images, test_labels, repeats=1)[1])
+    if args.epochs:
+        train_sequence = input_pipeline.TrainingSequence(images, labels, train_indices, batch_size, input_shape)
+        pruned.fit_generator(train_sequence, validation_data=(validation_images, validation_labels),
+                             epochs=args.epochs)
+
+    if args.clusters:
+        cluster_weights(pruned, layers, args.clusters)
+
+    pruned.save(args.output)
+    report('Compressed', pruned, args.output, test_images, test_labels)
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+from packed_dataset import is_packed_dataset
+import preprocessing
+
+# a cache entry is a directory named by its key with the files:
+#   images.npy  - preprocessed images of all classes, sorted by class
+#   offsets.npy - images of class c are images[offsets[c]:offsets[c + 1]]
+_IMAGES_FILE = 'images.npy'
+_OFFSETS_FILE = 'offsets.npy'
+
+
+def dataset_fingerprint(path):
+    """Hash of the names, sizes and modification times of all files the data set consists of."""
+    if is_packed_dataset(path):
+        files = [os.path.join(path, f) for f in ('images.npy', 'labels.npy', 'offsets.npy')]
+    else:
+        files = [os.path.join(root, f)
+                 for d in sorted(os.listdir(path)) if d.isdigit() and os.path.isdir(os.path.join(path, d))
+                 for root, _, names in os.walk(os.path.join(path, d)) for f in sorted(names)]
+
+    digest = hashlib.sha256()
+    for file in files:
+        stat = os.stat(file)
+        digest.update(f'{os.path.relpath(file, path)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+
+    return digest.hexdigest()
+
+
+def cache_key(path, input_shape, grayscale, equalization, stage='preprocessed'):
+    configuration = {'dataset': dataset_fingerprint(path), 'input_shape': list(input_shape), 'grayscale': grayscale,
+                     'equalization': equalization, 'stage': stage, 'version': preprocessing.VERSION}
+    return hashlib.sha256(json.dumps(configuration, sort_keys=True).encode()).hexdigest()
+
+
+class DatasetCache:
+    """Content-addressed cache of preprocessed data sets, least recently used entries are evicted once the cache
+    grows over max_bytes."""
+
+    def __init__(self, cache_dir, max_bytes=10 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, key):
+        """Returns memory-mapped (images, offsets) or None if the key is not cached."""
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            return None
+
+        os.utime(entry)
+        return (np.load(os.path.join(entry, _IMAGES_FILE), mmap_mode='r'),
+                np.load(os.path.join(entry, _OFFSETS_FILE)))
+
+    def store(self, key, images, offsets):
+        entry = os.path.join(self.cache_dir, key)
+        tmp = entry + '.tmp'
+
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, _IMAGES_FILE), images)
+        np.save(os.path.join(tmp, _OFFSETS_FILE), offsets)
+
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            if key.endswith('.tmp') or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, key))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+
+            print('Evicting cached data set', key)
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total -= size
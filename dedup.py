@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+import numpy as np
+from packed_dataset import is_packed_dataset, load_packed_dataset, list_class_files, save_groups
+
+_NUMBER_OF_CLASSES = 93
+
+
+def dhash(image, size=8):
+    """64 bit difference hash - compares neighbouring pixels of a downscaled grayscale image."""
+    img = image if isinstance(image, Image.Image) else Image.fromarray(image)
+    pixels = np.asarray(img.convert('L').resize((size + 1, size), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def dhash_file(file):
+    with Image.open(file) as img:
+        return dhash(img)
+
+
+class BKTree:
+    """Metric tree over hamming distances of hashes, finds all hashes within a distance without comparing to all."""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = (value, item, {})
+            return
+
+        node = self.root
+        while True:
+            distance = bin(node[0] ^ value).count('1')
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, item, {})
+                return
+            node = child
+
+    def find(self, value, threshold):
+        """Returns the items whose hashes are at most threshold bits from value."""
+        found = []
+        stack = [self.root] if self.root is not None else []
+
+        while stack:
+            node = stack.pop()
+            distance = bin(node[0] ^ value).count('1')
+            if distance <= threshold:
+                found.append(node[1])
+
+            for d, child in node[2].items():
+                if distance - threshold <= d <= distance + threshold:
+                    stack.append(child)
+
+        return found
+
+
+def find_groups(hashes, labels, threshold):
+    """Groups near-duplicate images of the same class, returns the group id of every image."""
+    parents = np.arange(len(hashes))
+
+    def root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    trees = [BKTree() for _ in range(_NUMBER_OF_CLASSES)]
+    for i, (value, c) in enumerate(zip(hashes, labels)):
+        for j in trees[c].find(value, threshold):
+            parents[root(j)] = root(i)
+        trees[c].add(value, i)
+
+    roots = np.array([root(i) for i in range(len(hashes))])
+    _, groups = np.unique(roots, return_inverse=True)
+    return groups
+
+
+def hash_dataset(path, workers=None):
+    """Returns the hashes and labels of all images in the order of list_class_files (and the packed data sets)."""
+    if is_packed_dataset(path):
+        images, labels, _ = load_packed_dataset(path)
+        return [dhash(image) for image in images], np.asarray(labels), None
+
+    files = list_class_files(path)
+    all_files = [f for class_files in files for f in class_files]
+    labels = np.array([c for c, class_files in enumerate(files) for _ in class_files])
+
+    with ProcessPoolExecutor(workers) as executor:
+        hashes = list(executor.map(dhash_file, all_files, chunksize=256))
+
+    return hashes, labels, all_files
+
+
+def first_of_groups(groups):
+    """Mask of the first image of every group, the images kept when the duplicates are dropped."""
+    _, first = np.unique(groups, return_index=True)
+    keep = np.zeros(len(groups), dtype=bool)
+    keep[first] = True
+    return keep
+
+
+def drop_duplicates(path, files, groups, duplicates_dir):
+    """Moves all but the first image of every group to duplicates_dir, returns the mask of kept images."""
+    keep = first_of_groups(groups)
+
+    for file in np.array(files)[~keep]:
+        target = os.path.join(duplicates_dir, os.path.relpath(file, path))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(file, target)
+
+    return keep
+
+
+def time_epochs(path, files, labels, keep, input_shape=(32, 32), batch_size=64, repeats=2):
+    """Seconds of one training epoch of the train.py model on all images and on the kept ones, the best of repeats
+    epochs each. The images are read in the order of hash_dataset, so keep applies to them."""
+    from benchmark import timed
+    from train import build_model
+    import preprocessing
+
+    if files is None:
+        images = preprocessing.preprocess(load_packed_dataset(path)[0], input_shape)
+    else:
+        decoded = []
+        for file in files:
+            with Image.open(file) as img:
+                decoded.append(np.array(img.convert('RGB')))
+        images = preprocessing.preprocess(decoded, input_shape)
+
+    model = build_model(images.shape[1:])
+    # the first epoch includes the building of the graph
+    model.fit(images[:batch_size], labels[:batch_size], batch_size=batch_size, epochs=1, verbose=0)
+
+    times = []
+    for subset in (np.ones(len(images), dtype=bool), keep):
+        seconds, _ = timed(lambda: model.fit(images[subset], labels[subset], batch_size=batch_size, epochs=1,
+                                             verbose=0), repeats)
+        times.append(seconds)
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='path to the data folder or a packed data set')
+    parser.add_argument('--threshold', type=int, default=4, help='maximum hamming distance of near-duplicate hashes')
+    parser.add_argument('--drop', action='store_true',
+                        help='move duplicates out of the data folder instead of only grouping them')
+    parser.add_argument('--duplicates-dir', help='where dropped images are moved, path/../duplicates by default')
+    parser.add_argument('--workers', type=int, help='number of hashing processes')
+    parser.add_argument('--time-epoch', action='store_true',
+                        help='measure a training epoch of train.py on the data set with and without the duplicates')
+    args = parser.parse_args()
+
+    print('Hashing images')
+    hashes, labels, files = hash_dataset(args.path, args.workers)
+
+    print('Finding near-duplicates')
+    groups = find_groups(hashes, labels, args.threshold)
+
+    total, unique = len(groups), int(groups.max()) + 1 if len(groups) else 0
+    print(f'{total} images in {unique} groups, {total - unique} near-duplicates ({(total - unique) / total:.1%})')
+    if unique:
+        print(f'Without them the data set shrinks {total / unique:.2f}x (image count ratio)')
+
+    if args.time_epoch:
+        # before --drop moves the files
+        print('Timing training epochs')
+        full, deduplicated = time_epochs(args.path, files, labels, first_of_groups(groups))
+        print(f'Epoch: {full:.2f} s with the duplicates, {deduplicated:.2f} s without them, '
+              f'{full / deduplicated:.2f}x faster')
+
+    if args.drop:
+        if files is None:
+            parser.error('--drop only works on a data folder, pack it again afterwards')
+
+        duplicates_dir = args.duplicates_dir or os.path.join(os.path.dirname(os.path.abspath(args.path)),
+                                                             'duplicates')
+        keep = drop_duplicates(args.path, files, groups, duplicates_dir)
+        groups = np.unique(groups[keep], return_inverse=True)[1]
+        print(f'Moved {total - unique} images to {duplicates_dir}')
+
+    save_groups(args.path, groups)
+    print('Saved groups to', args.path)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+from instrumentation import Tracer
+from label_image import list_images, load_ensemble, read_labels
+import preprocessing
+
+# hue, saturation and value ranges (PIL HSV, all in 0-255) of the red and blue parts of european traffic signs
+_SIGN_COLORS = {'red': [((0, 10), (90, 255), (50, 255)), ((235, 255), (90, 255), (50, 255))],
+                'blue': [((135, 175), (120, 255), (40, 255))]}
+
+
+def color_proposals(frame, scale=4, min_size=24, max_size=400, padding=0.15):
+    """Boxes (x0, y0, x1, y1) around red and blue blobs of a plausible sign size and shape. The color masks are
+    computed on a frame downscaled by scale, a 1080p frame takes a few milliseconds."""
+    height, width = frame.shape[:2]
+    small = Image.fromarray(frame).reduce(scale) if scale > 1 else Image.fromarray(frame)
+    hsv = np.asarray(small.convert('HSV'))
+
+    boxes = []
+    for ranges in _SIGN_COLORS.values():
+        mask = np.zeros(hsv.shape[:2], dtype=bool)
+        for (h0, h1), (s0, s1), (v0, v1) in ranges:
+            mask |= ((hsv[..., 0] >= h0) & (hsv[..., 0] <= h1) & (hsv[..., 1] >= s0) & (hsv[..., 1] <= s1) &
+                     (hsv[..., 2] >= v0) & (hsv[..., 2] <= v1))
+
+        # close the gaps between the border of a sign and its inner symbol
+        mask = ndimage.binary_closing(mask, iterations=2)
+        blobs, _ = ndimage.label(mask)
+
+        for rows, cols in ndimage.find_objects(blobs):
+            h, w = (rows.stop - rows.start) * scale, (cols.stop - cols.start) * scale
+            if not min_size <= max(h, w) <= max_size or not 0.5 <= h / w <= 2:
+                continue
+
+            # a square box around the blob, the classifier was trained on square crops with a margin
+            size = max(h, w) * (1 + 2 * padding)
+            cy, cx = (rows.start + rows.stop) / 2 * scale, (cols.start + cols.stop) / 2 * scale
+            boxes.append((cx - size / 2, cy - size / 2, cx + size / 2, cy + size / 2))
+
+    boxes = np.array(boxes, dtype=np.float32).reshape((-1, 4))
+    return np.clip(boxes, 0, [width, height, width, height])
+
+
+def sliding_window_proposals(frame, sizes=(32, 48, 64, 96, 128), stride=0.5):
+    """Square windows of every size, shifted by stride * size."""
+    height, width = frame.shape[:2]
+    boxes = []
+    for size in sizes:
+        step = max(1, int(size * stride))
+        ys, xs = np.meshgrid(np.arange(0, height - size + 1, step), np.arange(0, width - size + 1, step),
+                             indexing='ij')
+        xs, ys = xs.ravel(), ys.ravel()
+        boxes.append(np.stack([xs, ys, xs + size, ys + size], axis=1))
+
+    return np.concatenate(boxes, axis=0).astype(np.float32) if boxes else np.zeros((0, 4), dtype=np.float32)
+
+
+def _bilinear(frame, ys, xs):
+    """float32 bilinear samples of the frame at the continuous coordinates ys (N, h) and xs (N, w), pixel centers
+    are at integer + 0.5."""
+    height, width = frame.shape[:2]
+    ys = np.clip(ys - 0.5, 0, height - 1)
+    xs = np.clip(xs - 0.5, 0, width - 1)
+    y0, x0 = ys.astype(np.int64), xs.astype(np.int64)
+    y1, x1 = np.minimum(y0 + 1, height - 1), np.minimum(x0 + 1, width - 1)
+    # float32 throughout, float64 temporaries doubled the memory of the decode workers
+    wy = (ys - y0).astype(np.float32)[:, :, np.newaxis, np.newaxis]
+    wx = (xs - x0).astype(np.float32)[:, np.newaxis, :, np.newaxis]
+
+    y0, y1 = y0[:, :, np.newaxis], y1[:, :, np.newaxis]
+    x0, x1 = x0[:, np.newaxis, :], x1[:, np.newaxis, :]
+    top = frame[y0, x0].astype(np.float32)
+    top += (frame[y0, x1] - top) * wx
+    bottom = frame[y1, x0].astype(np.float32)
+    bottom += (frame[y1, x1] - bottom) * wx
+    top += (bottom - top) * wy
+    return top
+
+
+def crop_and_resize(frame, boxes, size, supersample=2, max_bytes=64 * 2 ** 20):
+    """Crops all boxes and resizes them to size x size with vectorized bilinear sampling. Every output pixel is the
+    mean of supersample x supersample bilinear samples inside its cell, which stands in for the antialiasing of the
+    LANCZOS resize the classifier was trained with when large boxes are shrunk to 32x32."""
+    steps = (np.arange(size * supersample, dtype=np.float32) + 0.5) / (size * supersample)
+    crops = np.empty((len(boxes), size, size) + frame.shape[2:], dtype=np.uint8)
+
+    # in chunks of boxes, the float samples of all of them at once could take gigabytes, a chunk keeps the about five
+    # float32 sample arrays of _bilinear below max_bytes
+    samples_per_box = (size * supersample) ** 2 * int(np.prod(frame.shape[2:]))
+    chunk = max(1, max_bytes // (5 * 4 * samples_per_box))
+    for start in range(0, len(boxes), chunk):
+        b = boxes[start:start + chunk]
+        xs = b[:, 0:1] + (b[:, 2:3] - b[:, 0:1]) * steps
+        ys = b[:, 1:2] + (b[:, 3:4] - b[:, 1:2]) * steps
+        samples = _bilinear(frame, ys, xs)
+        samples = samples.reshape((len(b), size, supersample, size, supersample) + samples.shape[3:]).mean(axis=(2, 4))
+        crops[start:start + chunk] = np.clip(np.rint(samples), 0, 255)
+
+    return crops
+
+
+def non_max_suppression(boxes, scores, iou_threshold=0.3):
+    """Indices of the boxes kept by greedy non-max suppression, best first."""
+    x0, y0, x1, y1 = boxes.T
+    areas = (x1 - x0) * (y1 - y0)
+    order = np.argsort(scores)[::-1]
+
+    keep = []
+    while len(order):
+        best, rest = order[0], order[1:]
+        keep.append(best)
+
+        w = np.maximum(0, np.minimum(x1[best], x1[rest]) - np.maximum(x0[best], x0[rest]))
+        h = np.maximum(0, np.minimum(y1[best], y1[rest]) - np.maximum(y0[best], y0[rest]))
+        intersection = w * h
+        iou = intersection / (areas[best] + areas[rest] - intersection)
+        order = rest[iou <= iou_threshold]
+
+    return np.array(keep, dtype=np.int64)
+
+
+def load_frame(file, input_shape, grayscale, equalize, proposals='color'):
+    """Decodes a frame and returns its candidate boxes and their preprocessed crops."""
+    with Image.open(file) as img:
+        frame = np.asarray(img.convert('RGB'))
+
+    boxes = color_proposals(frame) if proposals == 'color' else sliding_window_proposals(frame)
+    if not len(boxes):
+        return boxes, None
+
+    crops = crop_and_resize(frame, boxes, input_shape[0])
+    return boxes, preprocessing.preprocess(crops, input_shape, grayscale, equalize)
+
+
+def detect_frames(model, files, input_shape, grayscale=False, equalize=False, proposals='color', min_score=0.9,
+                  iou_threshold=0.3, batch_size=1024, workers=None, tracer=None):
+    """Yields (file, [(box, class, probability), ...]) for all frames. The frames are decoded and their proposals
+    cropped in a pool of worker processes while the model scores the crops of the previous frames, all crops of
+    a frame in one predict call."""
+    tracer = tracer or Tracer()
+    load = partial(load_frame, input_shape=input_shape, grayscale=grayscale, equalize=equalize, proposals=proposals)
+    workers = workers or os.cpu_count()
+
+    with ProcessPoolExecutor(workers) as executor:
+        window = 2 * workers
+        pending = deque(executor.submit(load, file) for file in files[:window])
+
+        for i, file in enumerate(files):
+            with tracer.stage('wait_for_frame'):
+                boxes, crops = pending.popleft().result()
+            if i + window < len(files):
+                pending.append(executor.submit(load, files[i + window]))
+
+            detections = []
+            if len(boxes):
+                with tracer.stage('predict', len(boxes)):
+                    predictions = model.predict(crops, batch_size=batch_size)
+
+                with tracer.stage('nms'):
+                    classes = predictions.argmax(axis=1)
+                    scores = predictions.max(axis=1)
+                    candidates = np.flatnonzero(scores >= min_score)
+                    keep = candidates[non_max_suppression(boxes[candidates], scores[candidates], iou_threshold)]
+                    detections = [(boxes[j].round().astype(int).tolist(), int(classes[j]), float(scores[j]))
+                                  for j in keep]
+
+            yield file, detections
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='finds and classifies the traffic signs in full frames')
+    parser.add_argument('frames', help='directory, glob pattern or file with a list of frames')
+    parser.add_argument('--model', nargs='+', default=['models/model.h5'], help='keras .h5 or exported .tflite')
+    parser.add_argument('--labels', default='labels.txt')
+    parser.add_argument('--grayscale', action='store_true')
+    parser.add_argument('--equalize', action='store_true')
+    parser.add_argument('--proposals', choices=['color', 'sliding'], default='color',
+                        help='red and blue blobs or a multi-scale sliding window')
+    parser.add_argument('--min-score', type=float, default=0.9, help='minimum probability of a detection')
+    parser.add_argument('--iou', type=float, default=0.3, help='overlap above which the weaker detection is dropped')
+    parser.add_argument('--batch-size', type=int, default=1024)
+    parser.add_argument('--workers', type=int, help='number of processes decoding the frames')
+    parser.add_argument('--output', help='jsonl file with the detections, standard output by default')
+    args = parser.parse_args()
+
+    input_shape = (32, 32)
+    tracer = Tracer()
+    labels = read_labels(args.labels)
+    model = load_ensemble(args.model)
+    files = list_images(args.frames)
+
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    with tracer.stage('detect', len(files)):
+        for file, detections in detect_frames(model, files, input_shape, args.grayscale, args.equalize,
+                                              args.proposals, args.min_score, args.iou, args.batch_size,
+                                              args.workers, tracer):
+            output.write(json.dumps({'image': file,
+                                     'detections': [{'box': box, 'class': c, 'label': labels[c], 'probability': p}
+                                                    for box, c, p in detections]},
+                                    ensure_ascii=False) + '\n')
+    if args.output:
+        output.close()
+
+    tracer.print_summary(sys.stderr)
+    detect = tracer.summary()['detect']
+    print(f'{len(files)} frames, {detect["images_per_second"] or 0:.1f} frames/s', file=sys.stderr)
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import numpy as np
+from tensorflow import keras
+from build_model import build_model
+from dataset_cache import dataset_fingerprint
+from prediction_cache import model_digest
+import preprocessing
+
+_PREDICTIONS_FILE = 'teacher_predictions.npz'
+
+
+def teacher_predictions(path, teacher_file, images, grayscale, equalization, batch_size=1024):
+    """Predictions of the teacher for all uint8 images of the data set, saved next to it so the teacher runs only
+    once per data set and teacher, not every epoch and not every training run."""
+    predictions_file = os.path.join(path, _PREDICTIONS_FILE)
+    configuration = {'teacher': model_digest(teacher_file), 'dataset': dataset_fingerprint(path),
+                     'shape': list(images.shape), 'grayscale': bool(grayscale), 'equalization': bool(equalization),
+                     'version': preprocessing.VERSION}
+    # the images themselves too, the predictions are stored in their order
+    digest = hashlib.sha256(json.dumps(configuration, sort_keys=True).encode())
+    for i in range(0, len(images), batch_size):
+        digest.update(np.ascontiguousarray(images[i:i + batch_size]).tobytes())
+    key = digest.hexdigest()
+
+    if os.path.isfile(predictions_file):
+        saved = np.load(predictions_file)
+        if str(saved['key']) == key:
+            print('Using teacher predictions from', predictions_file)
+            return saved['predictions']
+
+    print('Predicting the data set with the teacher', teacher_file)
+    teacher = keras.models.load_model(teacher_file, compile=False)
+    if teacher.input_shape[1:] != images.shape[1:]:
+        raise ValueError(f'the teacher expects images of shape {teacher.input_shape[1:]}, the data set has '
+                         f'{images.shape[1:]}')
+
+    predictions = np.concatenate([teacher.predict(preprocessing.normalize(images[i:i + batch_size]))
+                                  for i in range(0, len(images), batch_size)]).astype(np.float32)
+    np.savez(predictions_file, key=key, predictions=predictions)
+    print('Saved teacher predictions to', predictions_file)
+
+    return predictions
+
+
+def soften(probabilities, temperature):
+    """softmax(log(probabilities) / temperature), the teacher is a softmax model so this is its softmax at
+    the given temperature."""
+    logits = np.log(np.clip(probabilities.astype(np.float64), 1e-12, 1)) / temperature
+    logits -= logits.max(axis=1, keepdims=True)
+    softened = np.exp(logits)
+    return (softened / softened.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+def distillation_targets(labels, soft_targets):
+    """The targets of the distillation loss, the hard label in the first column followed by the soft targets."""
+    return np.concatenate([np.asarray(labels, dtype=np.float32)[:, np.newaxis], soft_targets], axis=1)
+
+
+def distillation_loss(temperature=4.0, alpha=0.7):
+    """alpha * T^2 * KL(teacher_T || student_T) + (1 - alpha) * cross entropy with the hard labels, y_true is
+    made by distillation_targets."""
+    K = keras.backend
+
+    def distillation_loss(y_true, y_pred):
+        y_pred = K.cast(y_pred, 'float32')
+        labels, soft = y_true[:, 0], y_true[:, 1:]
+        hard_loss = keras.losses.sparse_categorical_crossentropy(labels, y_pred)
+
+        student = K.softmax(K.log(K.clip(y_pred, K.epsilon(), 1.0)) / temperature)
+        soft_loss = K.sum(soft * (K.log(K.clip(soft, K.epsilon(), 1.0)) - K.log(K.clip(student, K.epsilon(), 1.0))),
+                          axis=-1)
+        # T^2 keeps the gradients of the soft part independent of the temperature
+        return alpha * temperature ** 2 * soft_loss + (1 - alpha) * hard_loss
+
+    return distillation_loss
+
+
+def distillation_accuracy(y_true, y_pred):
+    return keras.metrics.sparse_categorical_accuracy(y_true[:, :1], y_pred)
+
+
+def build_student(input_shape, conv_depth, dense_depth, temperature=4.0, alpha=0.7):
+    """One of the smaller architectures of build_model.py compiled with the distillation loss."""
+    model = build_model(input_shape, conv_depth, dense_depth, keras.optimizers.Adam(),
+                        keras.losses.sparse_categorical_crossentropy)
+    model.compile(optimizer=keras.optimizers.Adam(), loss=distillation_loss(temperature, alpha),
+                  metrics=[distillation_accuracy])
+    return model
+
+
+def custom_objects(temperature=4.0, alpha=0.7):
+    """What keras needs to load a student saved during the distillation, for example from a checkpoint."""
+    return {'distillation_loss': distillation_loss(temperature, alpha), 'distillation_accuracy': distillation_accuracy}
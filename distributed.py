@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from tensorflow import keras
+
+
+def cluster_size_and_index():
+    """Number of workers and index of this one from the TF_CONFIG environment variable."""
+    config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    if not config:
+        return 1, 0
+
+    return len(config['cluster']['worker']), config['task']['index']
+
+
+class ThroughputCallback(keras.callbacks.Callback):
+    """Measures the training throughput of the whole cluster in images per second."""
+
+    def __init__(self, batch_size, num_workers=1, output=None):
+        super().__init__()
+        self.images_per_step = batch_size * num_workers
+        self.output = output
+        self.throughputs = []
+        self.steps = 0
+        self.start = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.steps = 0
+        self.start = time.perf_counter()
+
+    def on_batch_end(self, batch, logs=None):
+        self.steps += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        throughput = self.steps * self.images_per_step / (time.perf_counter() - self.start)
+        self.throughputs.append(throughput)
+        print(f'\nThroughput: {throughput:.1f} images/s')
+
+    def on_train_end(self, logs=None):
+        if self.output and self.throughputs:
+            # the first epoch includes the warm up, leave it out when there are more
+            throughputs = self.throughputs[1:] or self.throughputs
+            with open(self.output, 'w') as f:
+                json.dump({'images_per_second': sum(throughputs) / len(throughputs), 'epochs': self.throughputs}, f)
+
+
+def launch_local(num_workers, train_args, base_port=23456, throughput_file=None, poll_interval=1.0):
+    """Runs train.py as num_workers processes on this machine, returns the exit code of the chief or that of the
+    first worker that failed. The other workers would wait forever for a failed one in the all-reduce, so they are
+    terminated."""
+    cluster = {'worker': [f'localhost:{base_port + i}' for i in range(num_workers)]}
+    train = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+
+    processes = []
+    for i in range(num_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': i}}))
+        command = [sys.executable, train] + train_args + ['--distributed']
+        if i == 0 and throughput_file:
+            command += ['--throughput-file', throughput_file]
+        processes.append(subprocess.Popen(command, env=env))
+
+    try:
+        while True:
+            codes = [process.poll() for process in processes]
+            failed = [code for code in codes if code not in (None, 0)]
+            if failed:
+                return failed[0]
+            if all(code == 0 for code in codes):
+                return 0
+            time.sleep(poll_interval)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='measures how training throughput scales with the number of local '
+                                                 'workers, arguments after -- are passed to train.py')
+    parser.add_argument('--workers', default='1,2,4', help='comma separated numbers of workers to try')
+    parser.add_argument('--base-port', type=int, default=23456)
+    parser.add_argument('train_args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    train_args = args.train_args[1:] if args.train_args[:1] == ['--'] else args.train_args
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for num_workers in [int(n) for n in args.workers.split(',')]:
+            throughput_file = os.path.join(tmp, f'{num_workers}.json')
+            if launch_local(num_workers, train_args, args.base_port, throughput_file) != 0:
+                print('Training with', num_workers, 'workers failed', file=sys.stderr)
+                exit(1)
+
+            with open(throughput_file) as f:
+                results.append((num_workers, json.load(f)['images_per_second']))
+
+    print('workers images/s speedup efficiency')
+    for num_workers, throughput in results:
+        speedup = throughput / results[0][1] * results[0][0]
+        print(f'{num_workers:7d} {throughput:8.1f} {speedup:7.2f} {speedup / num_workers:10.2f}')
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import time
+from PIL import Image
+import numpy as np
+import tensorflow as tf
+from packed_dataset import is_packed_dataset, load_packed_dataset, list_class_files
+from tflite_model import TFLiteModel
+import preprocessing
+
+
+def sample_dataset(path, n, input_shape, grayscale, equalization, seed=123):
+    """Returns n random preprocessed images and their labels from the data folder or a packed data set."""
+    random_state = np.random.RandomState(seed)
+
+    if is_packed_dataset(path):
+        images, labels, _ = load_packed_dataset(path)
+        indices = np.sort(random_state.choice(len(images), min(n, len(images)), replace=False))
+        images, labels = images[indices], labels[indices].astype(np.int64)
+    else:
+        files = [(f, c) for c, class_files in enumerate(list_class_files(path)) for f in class_files]
+        indices = random_state.choice(len(files), min(n, len(files)), replace=False)
+        images = []
+        for i in indices:
+            with Image.open(files[i][0]) as img:
+                images.append(np.array(img))
+        labels = np.array([files[i][1] for i in indices])
+
+    return preprocessing.preprocess(images, input_shape, grayscale, equalization), labels
+
+
+def convert(model_file, quantization=None, calibration_images=None):
+    converter = tf.lite.TFLiteConverter.from_keras_model_file(model_file)
+
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        def representative_dataset():
+            for image in calibration_images:
+                yield [image[np.newaxis].astype(np.float32)]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    return converter.convert()
+
+
+def measure(model, images, labels, repeats=100):
+    """Returns the mean single image latency in ms and the accuracy on the images."""
+    model.predict(images[:1])
+    start = time.perf_counter()
+    for i in range(repeats):
+        model.predict(images[i % len(images)][np.newaxis])
+    latency = (time.perf_counter() - start) / repeats * 1000
+
+    predictions = np.concatenate([model.predict(images[i:i + 256]) for i in range(0, len(images), 256)])
+    accuracy = float(np.mean(np.argmax(predictions, axis=1) == labels))
+
+    return latency, accuracy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', help='keras model to be exported')
+    parser.add_argument('output', help='name of the exported .tflite file')
+    parser.add_argument('--quantize', choices=['none', 'float16', 'int8'], default='none',
+                        help='post-training quantization')
+    parser.add_argument('--data', help='data folder or packed data set used for calibration and comparison')
+    parser.add_argument('--samples', type=int, default=500, help='number of images used for calibration')
+    parser.add_argument('--equalize', action='store_true', help='the model was trained with histogram equalization')
+    args = parser.parse_args()
+
+    if args.quantize == 'int8' and not args.data:
+        parser.error('int8 quantization needs --data for calibration')
+
+    model = tf.keras.models.load_model(args.model)
+    input_shape = tuple(model.input_shape[2:0:-1])
+    grayscale = model.input_shape[3] == 1
+
+    images, labels = None, None
+    if args.data:
+        images, labels = sample_dataset(args.data, args.samples, input_shape, grayscale, args.equalize)
+
+    with open(args.output, 'wb') as f:
+        f.write(convert(args.model, None if args.quantize == 'none' else args.quantize, images))
+
+    print('Size:', os.path.getsize(args.model), 'B (.h5)', os.path.getsize(args.output), 'B (.tflite)')
+
+    if images is not None:
+        h5_latency, h5_accuracy = measure(model, images, labels)
+        tflite_latency, tflite_accuracy = measure(TFLiteModel(args.output), images, labels)
+
+        print(f'Latency: {h5_latency:.3f} ms (.h5) {tflite_latency:.3f} ms (.tflite)')
+        print(f'Accuracy: {h5_accuracy:.4f} (.h5) {tflite_accuracy:.4f} (.tflite)'
+              f' difference {tflite_accuracy - h5_accuracy:+.4f}')
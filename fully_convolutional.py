@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+import argparse
+import time
+from PIL import Image
+import numpy as np
+from tensorflow import keras
+import preprocessing
+
+
+def to_fully_convolutional(model):
+    """Rewrites a trained Sequential model of convolutions and pooling followed by Flatten and Dense layers into
+    a fully convolutional model accepting images of any size. The first dense layer becomes a convolution with the
+    size of the flattened feature map, the following ones 1x1 convolutions, all with the same weights. Dropout is
+    left out, it does nothing at inference."""
+    channels = model.input_shape[-1]
+    fcn = keras.models.Sequential(name=model.name + '_fcn')
+    fcn.add(keras.layers.InputLayer(input_shape=(None, None, channels)))
+
+    feature_shape = None
+    for layer in model.layers:
+        if isinstance(layer, keras.layers.Dropout):
+            continue
+
+        if isinstance(layer, keras.layers.Flatten):
+            feature_shape = layer.input_shape[1:]
+            continue
+
+        if isinstance(layer, keras.layers.Dense):
+            if feature_shape is None:
+                raise ValueError(f'dense layer {layer.name} is not preceded by a Flatten layer')
+
+            kernel, bias = layer.get_weights()
+            kernel_size = feature_shape[:2]
+            # Flatten of channels_last feature maps is a row-major reshape, so is this one
+            kernel = kernel.reshape(tuple(kernel_size) + (-1, layer.units))
+            conv = keras.layers.Conv2D(layer.units, kernel_size, activation=layer.activation, name=layer.name)
+            fcn.add(conv)
+            conv.set_weights([kernel, bias])
+            # the following dense layers see a 1x1 feature map
+            feature_shape = (1, 1)
+            continue
+
+        if not isinstance(layer, (keras.layers.Conv2D, keras.layers.MaxPooling2D, keras.layers.AveragePooling2D,
+                                  keras.layers.Activation)):
+            raise ValueError(f'layer {layer.name} of type {type(layer).__name__} can not be converted')
+
+        config = layer.get_config()
+        config.pop('batch_input_shape', None)
+        copy = type(layer).from_config(config)
+        fcn.add(copy)
+        copy.set_weights(layer.get_weights())
+
+    return fcn
+
+
+def window_geometry(model):
+    """Size (height, width) of the window seen by one output position and the stride between positions."""
+    stride = 1
+    for layer in model.layers:
+        if isinstance(layer, (keras.layers.Conv2D, keras.layers.MaxPooling2D, keras.layers.AveragePooling2D)):
+            stride *= layer.strides[0]
+    return tuple(model.input_shape[1:3]), stride
+
+
+def prepare(image, grayscale=False, equalization=False):
+    """Preprocesses a whole uint8 frame like preprocessing.preprocess does with a crop, without resizing it.
+    With equalization the histogram is that of the whole frame, not of every window."""
+    images = image[np.newaxis]
+    if grayscale:
+        images = preprocessing.to_grayscale(images)
+    if equalization:
+        images = preprocessing.image_histogram_equalization(images)
+    images = preprocessing.normalize(images)
+    if grayscale:
+        images = images[..., np.newaxis]
+    return images[0]
+
+
+def probability_map(fcn, image):
+    """Class probabilities of every window position of a preprocessed image, in one forward pass."""
+    return fcn.predict(image[np.newaxis])[0]
+
+
+def pyramid_maps(fcn, image, scales=(1.0, 0.75, 0.5), grayscale=False, equalization=False):
+    """Probability maps of the uint8 image resized by each scale, one forward pass per scale."""
+    maps = []
+    for scale in scales:
+        size = (max(1, int(image.shape[1] * scale)), max(1, int(image.shape[0] * scale)))
+        resized = np.asarray(Image.fromarray(image).resize(size, Image.LANCZOS))
+        maps.append(probability_map(fcn, prepare(resized, grayscale, equalization)))
+    return maps
+
+
+def window_crops(image, model, map_shape, positions=None):
+    """The input windows of the given (row, column) positions of the probability map, all positions by default."""
+    (height, width), stride = window_geometry(model)
+    if positions is None:
+        positions = [(i, j) for i in range(map_shape[0]) for j in range(map_shape[1])]
+
+    crops = np.stack([image[i * stride:i * stride + height, j * stride:j * stride + width] for i, j in positions])
+    return crops, positions
+
+
+def check(model, fcn, image, samples=200, seed=123):
+    """Largest absolute difference between the probability map and the original model on random windows."""
+    prediction_map = probability_map(fcn, image)
+    random_state = np.random.RandomState(seed)
+    positions = [(random_state.randint(prediction_map.shape[0]), random_state.randint(prediction_map.shape[1]))
+                 for _ in range(samples)]
+
+    crops, positions = window_crops(image, model, prediction_map.shape, positions)
+    expected = model.predict(crops)
+    actual = np.stack([prediction_map[i, j] for i, j in positions])
+    return float(np.abs(expected - actual).max())
+
+
+def measure(model, fcn, image, repeats=3):
+    """Returns the time in seconds of scoring every window of the image as separate crops with the original model
+    and as one forward pass of the fully convolutional model."""
+    prediction_map = probability_map(fcn, image)
+    crops, _ = window_crops(image, model, prediction_map.shape)
+    model.predict(crops[:1])
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.predict(crops, batch_size=1024)
+    crop_time = (time.perf_counter() - start) / repeats
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        probability_map(fcn, image)
+    fcn_time = (time.perf_counter() - start) / repeats
+
+    return crop_time, fcn_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='converts a trained model into a fully convolutional one producing '
+                                                 'a class probability map of a whole image')
+    parser.add_argument('model', help='keras model to be converted')
+    parser.add_argument('output', help='name of the converted .h5 file')
+    parser.add_argument('--image', default='example_sign.jpg', help='image the outputs and speed are compared on')
+    parser.add_argument('--size', type=int, default=256, help='the image is resized to size x size for the comparison')
+    parser.add_argument('--equalize', action='store_true', help='the model was trained with histogram equalization')
+    args = parser.parse_args()
+
+    model = keras.models.load_model(args.model, compile=False)
+    fcn = to_fully_convolutional(model)
+    fcn.save(args.output)
+    (window_height, window_width), stride = window_geometry(model)
+    print(f'Saved {args.output}, windows of {window_width}x{window_height} with a stride of {stride}')
+
+    grayscale = model.input_shape[3] == 1
+    with Image.open(args.image) as img:
+        image = np.asarray(img.convert('RGB').resize((args.size, args.size), Image.LANCZOS))
+    image = prepare(image, grayscale, args.equalize)
+
+    print(f'Largest difference to the original model: {check(model, fcn, image):.2e}')
+
+    crop_time, fcn_time = measure(model, fcn, image)
+    windows = np.prod(probability_map(fcn, image).shape[:2])
+    print(f'{windows} windows: {crop_time * 1000:.1f} ms as crops, {fcn_time * 1000:.1f} ms fully convolutional, '
+          f'speedup {crop_time / fcn_time:.1f}x')
@@ -0,0 +1,136 @@
+import random as rnd
+from PIL import Image
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from packed_dataset import is_packed_dataset, load_packed_dataset, list_class_files
+import preprocessing
+
+# augmentation imports imgaug, it is only imported when the images are augmented
+
+_AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def list_class_items(path):
+    """Returns the per class lists of items (file names or packed indices) and a method loading one item as uint8 array."""
+    if is_packed_dataset(path):
+        images, _, offsets = load_packed_dataset(path)
+        items = [list(range(offsets[c], offsets[c + 1])) for c in range(len(offsets) - 1)]
+        return items, lambda index: images[index]
+
+    return list_class_files(path), _load_file
+
+
+def _load_file(file):
+    with Image.open(file.decode() if isinstance(file, bytes) else file) as img:
+        return np.array(img)
+
+
+def make_dataset(items, load, input_shape, grayscale, equalization, batch_size, shuffle_buffer=0, repeat=False,
+                 num_shards=1, shard_index=0, seed=123, augment=False, dtype=np.float32, auto_shard=True):
+    """Builds a tf.data pipeline over the per class lists of items, returns the data set and number of batches per epoch.
+
+    Only the items are held in memory, images are loaded, resized and preprocessed by parallel maps while the model
+    trains on the previous batches."""
+    items_and_labels = [(item, c) for c in range(len(items)) for item in items[c]]
+    rnd.Random(seed).shuffle(items_and_labels)
+    items_and_labels = items_and_labels[shard_index::num_shards]
+
+    dataset = tf.data.Dataset.from_tensor_slices(([item for item, _ in items_and_labels],
+                                                  np.array([c for _, c in items_and_labels], dtype=np.int32)))
+
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    if repeat:
+        dataset = dataset.repeat()
+
+    channels = 1 if grayscale else 3
+
+    def load_and_resize(item):
+        return preprocessing.resize([load(item)], input_shape)[0]
+
+    def decode(item, label):
+        image = tf.py_func(load_and_resize, [item], tf.uint8, stateful=False)
+        image.set_shape((input_shape[1], input_shape[0], 3))
+        return image, label
+
+    def preprocess_batch(index, images, labels):
+        if augment:
+            from augmentation import augment_batch
+            images, labels = augment_batch(images, labels, np.random.RandomState([seed, index]))
+        return preprocessing.preprocess(images, input_shape, grayscale, equalization, dtype), labels.astype(np.int32)
+
+    def preprocess(index, batch):
+        images, labels = tf.py_func(preprocess_batch, [index, batch[0], batch[1]], [tf.as_dtype(dtype), tf.int32],
+                                    stateful=False)
+        images.set_shape((None, input_shape[1], input_shape[0], channels))
+        labels.set_shape((None,))
+        return images, labels
+
+    dataset = dataset.map(decode, num_parallel_calls=_AUTOTUNE)
+    dataset = dataset.batch(batch_size)
+    # the running batch index seeds the augmentation, so the augmented batches are reproducible
+    dataset = tf.data.Dataset.zip((tf.data.Dataset.range(2 ** 62), dataset))
+    dataset = dataset.map(preprocess, num_parallel_calls=_AUTOTUNE)
+    dataset = dataset.prefetch(_AUTOTUNE)
+
+    if not auto_shard:
+        # the data set is already sharded by worker, tf.distribute must not shard it again
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard = False
+        dataset = dataset.with_options(options)
+
+    return dataset, (len(items_and_labels) + batch_size - 1) // batch_size
+
+
+class TrainingSequence(keras.utils.Sequence):
+    """Shuffled batches of images[indices], gathered on request by the Keras workers so the training split is never
+    copied out of the (possibly memory-mapped) data set.
+
+    The images are uint8 and only normalized to dtype per batch. With augment every epoch sees a different (but
+    reproducible for the seed) augmented variant of them, with preprocess they are fully preprocessed per batch."""
+
+    def __init__(self, images, labels, indices, batch_size, input_shape, grayscale=False, equalization=False,
+                 augment=False, preprocess=False, seed=123, dtype=np.float32):
+        self.images = images
+        self.labels = np.asarray(labels)
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.input_shape = input_shape
+        self.grayscale = grayscale
+        self.equalization = equalization
+        self.augment = augment
+        self.preprocess = preprocess
+        self.seed = seed
+        self.dtype = dtype
+        self.epoch = 0
+        # batches of the current epoch done before a resume
+        self.skip = 0
+        self._order = None
+        self._order_epoch = None
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size - self.skip
+
+    def __getitem__(self, index):
+        index += self.skip
+        if self._order_epoch != self.epoch:
+            self._order = np.random.RandomState([self.seed, self.epoch]).permutation(len(self.indices))
+            self._order_epoch = self.epoch
+
+        batch = np.sort(self.indices[self._order[index * self.batch_size:(index + 1) * self.batch_size]])
+        images, labels = self.images[batch], self.labels[batch]
+
+        if self.augment:
+            from augmentation import augment_batch
+            images, labels = augment_batch(images, labels, np.random.RandomState([self.seed, self.epoch, index]))
+        if self.preprocess:
+            images = preprocessing.preprocess(images, self.input_shape, self.grayscale, self.equalization, self.dtype)
+        else:
+            images = preprocessing.normalize(images, self.dtype)
+
+        return images, labels
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.skip = 0
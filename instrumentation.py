@@ -0,0 +1,105 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Tracer:
+    """Records the wall time, throughput and peak memory of named stages and per batch step timings."""
+
+    def __init__(self):
+        self.events = []
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, images=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter(), images)
+
+    def record(self, name, start, end, images=None, category='stage'):
+        event = {'name': name, 'category': category, 'start': start - self.start, 'seconds': end - start,
+                 'peak_rss': peak_rss(), 'thread': threading.get_ident()}
+        if images is not None:
+            event['images'] = images
+            event['images_per_second'] = images / event['seconds'] if event['seconds'] else None
+
+        with self.lock:
+            self.events.append(event)
+
+    def summary(self):
+        """Totals per stage, stages entered several times (for example once per class) are summed."""
+        stages = {}
+        for event in self.events:
+            if event['category'] != 'stage':
+                continue
+
+            stage = stages.setdefault(event['name'], {'calls': 0, 'seconds': 0.0, 'images': 0, 'peak_rss': 0})
+            stage['calls'] += 1
+            stage['seconds'] += event['seconds']
+            stage['images'] += event.get('images') or 0
+            stage['peak_rss'] = max(stage['peak_rss'], event['peak_rss'])
+
+        for stage in stages.values():
+            stage['images_per_second'] = stage['images'] / stage['seconds'] if stage['images'] and stage['seconds'] \
+                else None
+
+        steps = [event['seconds'] for event in self.events if event['category'] == 'step']
+        if steps:
+            steps.sort()
+            stages['steps'] = {'calls': len(steps), 'seconds': sum(steps), 'mean': sum(steps) / len(steps),
+                               'p50': steps[len(steps) // 2],
+                               'p99': steps[min(len(steps) - 1, len(steps) * 99 // 100)]}
+
+        return stages
+
+    def print_summary(self, file=sys.stdout):
+        for name, stage in self.summary().items():
+            line = f'{name}: {stage["seconds"]:.3f} s'
+            if stage.get('images_per_second'):
+                line += f', {stage["images_per_second"]:.1f} images/s'
+            if 'peak_rss' in stage:
+                line += f', peak RSS {stage["peak_rss"] / 2 ** 20:.0f} MB'
+            print(line, file=file)
+
+    def save(self, file):
+        with open(file, 'w') as f:
+            json.dump({'summary': self.summary(), 'events': self.events}, f, indent=2)
+
+    def save_chrome_trace(self, file):
+        """Saves the events in the trace event format of chrome://tracing and Perfetto."""
+        pid = os.getpid()
+        trace = [{'name': event['name'], 'cat': event['category'], 'ph': 'X', 'pid': pid, 'tid': event['thread'],
+                  'ts': event['start'] * 1e6, 'dur': event['seconds'] * 1e6,
+                  'args': {k: v for k, v in event.items() if k in ('images', 'images_per_second', 'peak_rss')}}
+                 for event in self.events]
+
+        with open(file, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+def step_timing_callback(tracer, batch_size):
+    """Keras callback recording the duration of every training batch in the tracer."""
+    from tensorflow import keras
+
+    batch_start = [None]
+
+    def on_batch_begin(batch, logs):
+        batch_start[0] = time.perf_counter()
+
+    def on_batch_end(batch, logs):
+        tracer.record('step', batch_start[0], time.perf_counter(), batch_size, category='step')
+
+    return keras.callbacks.LambdaCallback(on_batch_begin=on_batch_begin, on_batch_end=on_batch_end)
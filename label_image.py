@@ -1,43 +1,204 @@
 import numpy as np
-import tensorflow as tf
 from PIL import Image
 import argparse
+import csv
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import preprocessing
+from instrumentation import Tracer
+from prediction_cache import LazyModel, PredictionCache, predict_cached
 
+# tensorflow is imported only when a keras model is loaded, so reading the arguments and labels and running a .tflite
+# model through tflite_runtime do not pay for its import
 
-def resize(image, size, method=Image.ANTIALIAS):
-    img = Image.fromarray(image)
-    return np.array(img.resize(size, method))
+_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp')
 
 
-def to_grayscale(image):
-    return 0.299 * image[:, :, 0] + 0.587 * image[:, :, 1] + 0.114 * image[:, :, 2]
+def read_labels(label_file):
+    with open(label_file, encoding='utf-8') as f:
+        return [l.rstrip() for l in f]
 
 
-def normalize(image):
-    return image / 255.0
+def load_model(model_file):
+    if model_file.endswith('.tflite'):
+        from tflite_model import TFLiteModel
+        return TFLiteModel(model_file)
 
+    from tensorflow import keras
+    # the optimizer state is not needed for predictions and takes a while to restore
+    return keras.models.load_model(model_file, compile=False)
 
-def image_histogram_equalization(image, number_bins=256):
-    image_histogram, bins = np.histogram(image.flatten(), number_bins, density=True)
-    cdf = image_histogram.cumsum()
-    cdf = 255 * cdf / cdf[-1]
 
-    image_equalized = np.interp(image.flatten(), bins[:-1], cdf)
+def load_ensemble(model_files):
+    """Combines several keras models with the same input into one model averaging their predictions, so one
+    predict call runs all of them."""
+    if len(model_files) == 1:
+        return load_model(model_files[0])
+    if any(model_file.endswith('.tflite') for model_file in model_files):
+        raise ValueError('an ensemble can only be built from keras models')
 
-    return image_equalized.reshape(image.shape)
+    from tensorflow import keras
+    members = [load_model(model_file) for model_file in model_files]
+    inputs = keras.layers.Input(shape=members[0].input_shape[1:])
+    # the members are renamed, models saved by the same script share their names
+    outputs = [keras.models.Model(m.inputs, m.outputs, name=f'member_{i}')(inputs) for i, m in enumerate(members)]
+    return keras.models.Model(inputs, keras.layers.Average()(outputs), name='ensemble')
 
 
-def read_labels(label_file):
-    label = []
-    proto_as_ascii_lines = tf.gfile.GFile(label_file).readlines()
-    for l in proto_as_ascii_lines:
-        label.append(l.rstrip())
-    return label
+def tflite_file(model_file):
+    """The .tflite export of a keras model, expected next to it as written by export_tflite.py."""
+    tflite = os.path.splitext(model_file)[0] + '.tflite'
+    if not os.path.isfile(tflite):
+        raise FileNotFoundError(f'{tflite} does not exist, create it with export_tflite.py {model_file} ...')
+    return tflite
+
+
+def profile_imports(argv, top=15):
+    """Runs this script again with python -X importtime and prints the modules that took the longest to import,
+    returns the exit code of the run."""
+    run = subprocess.run([sys.executable, '-X', 'importtime', os.path.abspath(__file__)] + argv,
+                         stderr=subprocess.PIPE, universal_newlines=True)
+
+    imports = []
+    for line in run.stderr.splitlines():
+        if not line.startswith('import time:'):
+            sys.stderr.write(line + '\n')
+            continue
+        fields = line[len('import time:'):].split('|')
+        if fields[0].strip().isdigit():
+            imports.append((int(fields[1]), int(fields[0]), fields[2].strip()))
+
+    print(f'import time: {sum(s for _, s, _ in imports) / 1e6:.3f} s in {len(imports)} modules', file=sys.stderr)
+    print(' cumulative ms  self ms  module', file=sys.stderr)
+    for cumulative, self_time, name in sorted(imports, reverse=True)[:top]:
+        print(f'{cumulative / 1000:14.1f} {self_time / 1000:8.1f}  {name}', file=sys.stderr)
+
+    return run.returncode
+
+
+def list_images(source):
+    """Lists the images given by a directory, a newline-delimited file list or a glob pattern."""
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, f) for f in os.listdir(source) if f.lower().endswith(_IMAGE_EXTENSIONS))
+
+    if os.path.isfile(source) and not source.lower().endswith(_IMAGE_EXTENSIONS):
+        with open(source) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    return sorted(glob.glob(source, recursive=True))
+
+
+def load_batch(files, input_shape, grayscale, equalize, tta=None):
+    """Reads and preprocesses the images, with tta=(number of classes, arrows) returns all their symmetric views
+    stacked view by view. Returns the images of the readable files, None if there are none, and a dict with the
+    error message of every file that could not be read, one corrupt file does not fail the whole batch."""
+    images = []
+    errors = {}
+    for file in files:
+        try:
+            with Image.open(file) as img:
+                images.append(np.array(img))
+        except (OSError, ValueError) as e:
+            errors[file] = f'{type(e).__name__}: {e}'
+
+    if not images:
+        return None, errors
+
+    if tta is None:
+        return preprocessing.preprocess(images, input_shape, grayscale, equalize), errors
+
+    from tta import make_views, symmetric_views
+    images = preprocessing.preprocess(images, input_shape, grayscale, equalize, dtype=np.uint8)
+    return preprocessing.normalize(make_views(images, symmetric_views(*tta))), errors
+
+
+def predict_views(model, images, batch_size, tta=None, cache=None):
+    """One predict call for the whole (view-stacked) batch, with tta the views are averaged back to one row
+    per image."""
+    if cache is None:
+        predictions = model.predict(images, batch_size=batch_size)
+    else:
+        predictions = predict_cached(model, images, cache, batch_size)
+
+    if tta is None:
+        return predictions
+
+    from tta import combine_views, symmetric_views
+    return combine_views(predictions, symmetric_views(*tta))
+
+
+def top_k_results(predictions, k):
+    top_k = np.argsort(predictions, axis=1)[:, :-k - 1:-1]
+    return [[(int(i), float(p[i])) for i in row] for p, row in zip(predictions, top_k)]
+
+
+def classify_files(model, files, input_shape, grayscale=False, equalize=False, batch_size=256, k=5, workers=None,
+                   tracer=None, cache=None, tta=None):
+    """Yields (file, [(class, probability), ...], None) for all files, or (file, None, error message) for the files
+    that could not be read. The batches are decoded and preprocessed in a pool of worker processes while the model
+    predicts the previous ones. With a tracer the time spent waiting for the workers and predicting is recorded per
+    batch, with a cache only images not seen before are predicted."""
+    tracer = tracer or Tracer()
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    load = partial(load_batch, input_shape=input_shape, grayscale=grayscale, equalize=equalize, tta=tta)
+
+    workers = workers or os.cpu_count()
+
+    with ProcessPoolExecutor(workers) as executor:
+        # keep only a few batches ahead of the model so the memory does not grow with the number of files
+        window = 2 * workers
+        pending = deque(executor.submit(load, batch) for batch in batches[:window])
+
+        for i, batch in enumerate(batches):
+            with tracer.stage('wait_for_images', len(batch)):
+                images, errors = pending.popleft().result()
+            if i + window < len(batches):
+                pending.append(executor.submit(load, batches[i + window]))
+
+            results = iter([])
+            if images is not None:
+                with tracer.stage('predict', len(batch) - len(errors)):
+                    results = iter(top_k_results(predict_views(model, images, batch_size, tta, cache), k))
+            # in the order of the files, the failed ones in between
+            for file in batch:
+                if file in errors:
+                    yield file, None, errors[file]
+                else:
+                    yield file, next(results), None
+
+
+def write_results(results, labels, output, output_format='jsonl'):
+    """Writes the results of classify_files, a file that could not be read gets an error record instead. Returns the
+    number of those files."""
+    writer = csv.writer(output) if output_format == 'csv' else None
+    errors = 0
+    for file, top_k, error in results:
+        errors += error is not None
+        if writer is not None:
+            writer.writerow([file, 'error', error] if error is not None else
+                            [file] + [v for i, p in top_k for v in (labels[i], p)])
+        elif error is not None:
+            output.write(json.dumps({'image': file, 'error': error}, ensure_ascii=False) + '\n')
+        else:
+            output.write(json.dumps({'image': file,
+                                     'results': [{'class': i, 'label': labels[i], 'probability': p}
+                                                 for i, p in top_k]},
+                                    ensure_ascii=False) + '\n')
+    return errors
 
 
 if __name__ == '__main__':
+    tracer = Tracer()
+
     image_file = 'example_sign.jpg'
-    model_file = 'models/model.h5'
+    model_files = ['models/model.h5']
     label_file = 'labels.txt'
 
     do_grayscale = False
@@ -47,42 +208,104 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--image', help='image to be classified')
-    parser.add_argument('--model', help='model to be executed')
+    parser.add_argument('--model', nargs='+',
+                        help='model to be executed, keras .h5 or exported .tflite, several keras models are run as '
+                             'one ensemble averaging their predictions')
+    parser.add_argument('--tflite', action='store_true',
+                        help='run the .tflite export next to the keras model, without importing tensorflow when '
+                             'tflite_runtime is installed')
     parser.add_argument('--labels', help='name of file containing labels')
     parser.add_argument('--grayscale', help='convert to grayscale')
     parser.add_argument('--equalize', help='apply histogram equalization')
+    parser.add_argument('--batch', help='classify a directory, a glob pattern or a file with a list of images')
+    parser.add_argument('--batch-size', type=int, default=256, help='number of images predicted at once')
+    parser.add_argument('--top-k', type=int, default=5, help='number of results for every image')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl', help='output format of the batch mode')
+    parser.add_argument('--output', help='output file of the batch mode, standard output by default')
+    parser.add_argument('--workers', type=int, help='number of processes decoding the images in the batch mode')
+    parser.add_argument('--tta', action='store_true',
+                        help='average the predictions of the flipped and rotated views of every image, mapped back '
+                             'through the symmetry tables used by the training augmentation')
+    parser.add_argument('--tta-arrows', action='store_true', help='with --tta also rotate the arrow signs')
+    parser.add_argument('--cache', help='sqlite file caching the predictions of repeatedly classified images')
+    parser.add_argument('--cache-memory', type=int, default=100000,
+                        help='number of predictions cached in memory in front of the sqlite file')
+    parser.add_argument('--cache-size', type=int, default=256, help='maximum size of the sqlite cache in MB')
+    parser.add_argument('--trace', help='write the stage timings as json to this file')
+    parser.add_argument('--chrome-trace', help='write the stage timings to this file for chrome://tracing')
+    parser.add_argument('--profile-imports', action='store_true',
+                        help='print the modules that took the longest to import')
     args = parser.parse_args()
 
+    if args.profile_imports:
+        exit(profile_imports([a for a in sys.argv[1:] if a != '--profile-imports']))
+
     if args.image:
         image_file = args.image
     if args.model:
-        model_file = args.model
+        model_files = args.model
     if args.labels:
         label_file = args.labels
     if args.grayscale:
         do_grayscale = args.grayscale
     if args.equalize:
         do_equalize = args.equalize
+    if args.tflite:
+        model_files = [f if f.endswith('.tflite') else tflite_file(f) for f in model_files]
+    tracer.record('parse_args', tracer.start, time.perf_counter())
+
+    with tracer.stage('read_labels'):
+        labels = read_labels(label_file)
+    tta = (len(labels), args.tta_arrows) if args.tta else None
+
+    cache = None
+    if args.cache:
+        with tracer.stage('open_cache'):
+            cache = PredictionCache(args.cache, model_files, input_shape, do_grayscale, do_equalize,
+                                    args.cache_memory, args.cache_size * 2 ** 20)
 
-    image = Image.open(image_file).resize(input_shape, Image.LANCZOS)
-    image = np.array(image)
+    def load():
+        with tracer.stage('load_model'):
+            return load_ensemble(model_files)
 
-    if do_grayscale:
-        image = to_grayscale(image)
+    # with a cache the model is only loaded once an image misses it
+    model = LazyModel(load) if cache is not None else load()
 
-    if do_equalize:
-        image = image_histogram_equalization(image)
+    if args.batch:
+        files = list_images(args.batch)
+        results = classify_files(model, files, input_shape, do_grayscale, do_equalize, args.batch_size, args.top_k,
+                                 args.workers, tracer, cache, tta)
 
-    images = np.stack([normalize(image),], axis=0)
-    if do_grayscale:
-        images = np.expand_dims(images, 3)
+        with tracer.stage('classify', len(files)):
+            if args.output:
+                with open(args.output, 'w', newline='', encoding='utf-8') as output:
+                    errors = write_results(results, labels, output, args.format)
+            else:
+                errors = write_results(results, labels, sys.stdout, args.format)
+        if errors:
+            print(f'{errors} of {len(files)} images could not be read, see the error records', file=sys.stderr)
+    else:
+        with tracer.stage('read_and_preprocess', 1):
+            images, errors = load_batch([image_file], input_shape, do_grayscale, do_equalize, tta)
+        if errors:
+            exit(f'{image_file}: {errors[image_file]}')
 
-    model = tf.keras.models.load_model(model_file)
+        with tracer.stage('predict', 1):
+            results = predict_views(model, images, 256, tta, cache)[0]
 
-    results = np.squeeze(model.predict(images))
+        top_k = results.argsort()[-args.top_k:][::-1]
 
-    top_k = results.argsort()[-5:][::-1]
-    labels = read_labels(label_file)
+        for i in top_k:
+            print(labels[i], '[' + str(results[i]) + ']')
 
-    for i in top_k:
-        print(labels[i], '[' + str(results[i]) + ']')
+    # the summary goes to stderr so it does not mix with the results of the batch mode
+    tracer.print_summary(sys.stderr)
+    if cache is not None:
+        stats = cache.stats()
+        print(f'cache: {stats["lookups"]} lookups, {stats["memory_hits"]} memory hits, {stats["disk_hits"]} disk hits, '
+              f'hit rate {stats["hit_rate"] or 0:.1%}', file=sys.stderr)
+        cache.close()
+    if args.trace:
+        tracer.save(args.trace)
+    if args.chrome_trace:
+        tracer.save_chrome_trace(args.chrome_trace)
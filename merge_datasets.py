@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 import matplotlib.pyplot as plt
 import csv
+import hashlib
+import json
 import os
 from pathlib import Path
 from PIL import Image
 import numpy
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from sys import argv, stderr
 
 _GERMAN_DATASET_NUMBER_OF_CLASSES = 43
@@ -182,27 +185,248 @@ def load_and_merge_all_datasets(path):
 
 def make_final_dir(final, path):
     out_dir = path + '/data'
-    os.makedirs(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
 
     for i in range(_FINAL_DATASET_NUMBER_OF_CLASSES):
         in_dir = out_dir + '/' + format(i, '05d')
-        print('Creating dir', in_dir, '[' + len(final[i]) + 'images]')
-        os.makedirs(in_dir)
+        print('Creating dir', in_dir, '[' + str(len(final[i])) + ' images]')
+        os.makedirs(in_dir, exist_ok=True)
 
         for j in range(len(final[i])):
             image = final[i][j]
             Image.fromarray(image).save(in_dir + '/' + format(j, '05d') + '.jpg', 'JPEG')
 
 
-def pipeline(path):
-    final = load_and_merge_all_datasets(path)
-    make_final_dir(final, path)
+# streaming variants of the readers above, they only list the source files
+# and leave the decoding to the worker processes
+# yield: (path to image, source label)
+def list_traffic_signs(rootpath, classes):
+    for c in range(classes):
+        prefix = rootpath + '/' + format(c, '05d') + '/'
+        with open(prefix + 'GT-' + format(c, '05d') + '.csv') as gtFile:
+            gt_reader = csv.reader(gtFile, delimiter=';', )
+            gt_reader.__next__()
+            for row in gt_reader:
+                yield prefix + row[0], row[7]
+
+
+def list_german_dataset(path):
+    return list_traffic_signs(path, _GERMAN_DATASET_NUMBER_OF_CLASSES)
+
+
+def list_belgian_dataset(path):
+    return list_traffic_signs(path, _BELGIAN_DATASET_NUMBER_OF_CLASSES)
+
+
+def list_italian_dataset(path):
+    for c in range(_ITALIAN_DATASET_NUMBER_OF_CLASSES):
+        i = 0
+        prefix = path + '/' + str(c) + '/track'
+        while (Path(prefix + str(i))).is_dir():
+            for f in os.listdir(prefix + str(i)):
+                yield prefix + str(i) + '/' + f, str(c)
+
+            i += 1
+
+
+def list_chinese_dataset(path):
+    for f in os.listdir(path):
+        yield path + '/' + f, str(int(f[:3]))
+
+
+def list_czech_dataset(path):
+    for c in range(_CZECH_DATASET_NUMBER_OF_CLASSES):
+        dir_name = path + '/' + str(c)
+        for f in os.listdir(dir_name):
+            yield dir_name + '/' + f, str(c)
+
+
+# (name, lister, sub path, conversion table)
+_sources = [('german', list_german_dataset, '/german/data/Training', _german_to_final),
+            ('german', list_german_dataset, '/german/data/Testing', _german_to_final),
+            ('belgian', list_belgian_dataset, '/belgian/data/Training', _belgian_to_final),
+            ('belgian', list_belgian_dataset, '/belgian/data/Testing', _belgian_to_final),
+            ('italian', list_italian_dataset, '/italian/data/Training', _italian_to_final),
+            ('italian', list_italian_dataset, '/italian/data/Testing', _italian_to_final),
+            ('chinese', list_chinese_dataset, '/chinese/data/Training', _chinese_to_final),
+            ('chinese', list_chinese_dataset, '/chinese/data/Testing', _chinese_to_final),
+            ('czech', list_czech_dataset, '/czech/data', _czech_to_final)]
+
+
+def list_all_sources(path):
+    """Yields (dataset name, path to image, source label, final class or None) for every source image."""
+    for name, lister, sub_path, conversion in _sources:
+        print('Listing', name, 'dataset', sub_path)
+        for source_file, label in lister(path + sub_path):
+            yield name, source_file, label, conversion.get(label)
+
+
+def list_all_datasets(path):
+    for _, source_file, _, c in list_all_sources(path):
+        if c is not None:
+            yield source_file, c
+
+
+def convert_image(source_file, out_file):
+    with Image.open(source_file) as img:
+        img.convert('RGB').save(out_file, 'JPEG')
+
+
+def file_hash(file):
+    with open(file, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def convert_and_hash_image(source_file, out_file):
+    convert_image(source_file, out_file)
+    return file_hash(source_file)
+
+
+def run_bounded(executor, tasks, window, method=convert_image):
+    """Runs method(*task) for all tasks in the executor with at most `window` of them in flight,
+    yields (task, result) as they complete."""
+    pending = {}
+
+    for task in tasks:
+        pending[executor.submit(method, *task)] = task
+
+        if len(pending) >= window:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+
+    for future in list(pending):
+        yield pending.pop(future), future.result()
+
+
+def stream_merge_all_datasets(path, workers=None, window=256):
+    """Decodes all source images in a process pool and writes them straight to their final directories.
+
+    At most `window` images are in flight at any time, so memory does not grow with the size of the datasets."""
+    out_dir = path + '/data'
+    for i in range(_FINAL_DATASET_NUMBER_OF_CLASSES):
+        os.makedirs(out_dir + '/' + format(i, '05d'), exist_ok=True)
+
+    counts = [0 for _ in range(_FINAL_DATASET_NUMBER_OF_CLASSES)]
+
+    def tasks():
+        for source_file, c in list_all_datasets(path):
+            yield source_file, out_dir + '/' + format(c, '05d') + '/' + format(counts[c], '05d') + '.jpg'
+            counts[c] += 1
+
+    with ProcessPoolExecutor(workers) as executor:
+        for _ in run_bounded(executor, tasks(), window):
+            pass
+
+    for i in range(_FINAL_DATASET_NUMBER_OF_CLASSES):
+        print('Created dir', out_dir + '/' + format(i, '05d'), '[' + str(counts[i]) + ' images]')
+
+    return counts
+
+
+# the manifest maps every merged source image (path relative to the datasets folder) to
+# {'size', 'mtime', 'hash', 'dataset', 'label', 'final', 'output'}, output is relative to the data folder
+_MANIFEST_FILE = 'manifest.json'
+
+
+def load_manifest(out_dir):
+    manifest_file = out_dir + '/' + _MANIFEST_FILE
+    if not os.path.isfile(manifest_file):
+        return None
+
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def save_manifest(out_dir, manifest):
+    manifest_file = out_dir + '/' + _MANIFEST_FILE
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def incremental_merge(path, workers=None, window=256):
+    """Brings the data folder up to date with the source datasets, only new, changed or relabelled source images
+    are converted and only outputs of removed or relabelled ones are deleted."""
+    out_dir = path + '/data'
+    manifest = load_manifest(out_dir)
+
+    if manifest is None:
+        if os.path.isdir(out_dir) and os.listdir(out_dir):
+            raise RuntimeError(out_dir + ' exists but has no manifest, remove it to rebuild it from scratch')
+        manifest = {}
+
+    for i in range(_FINAL_DATASET_NUMBER_OF_CLASSES):
+        os.makedirs(out_dir + '/' + format(i, '05d'), exist_ok=True)
+
+    next_index = [0 for _ in range(_FINAL_DATASET_NUMBER_OF_CLASSES)]
+    for entry in manifest.values():
+        index = int(os.path.splitext(os.path.basename(entry['output']))[0])
+        next_index[entry['final']] = max(next_index[entry['final']], index + 1)
+
+    new_manifest = {}
+    tasks = []
+    unchanged = 0
+
+    for name, source_file, label, c in list_all_sources(path):
+        if c is None:
+            continue
+
+        key = os.path.relpath(source_file, path)
+        stat = os.stat(source_file)
+        entry = manifest.get(key)
+
+        if entry is not None and entry['final'] == c:
+            if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                new_manifest[key] = entry
+                unchanged += 1
+                continue
+
+            if file_hash(source_file) == entry['hash']:
+                new_manifest[key] = dict(entry, size=stat.st_size, mtime=stat.st_mtime_ns)
+                unchanged += 1
+                continue
+
+            output = entry['output']
+        else:
+            output = format(c, '05d') + '/' + format(next_index[c], '05d') + '.jpg'
+            next_index[c] += 1
+
+        new_manifest[key] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': None, 'dataset': name,
+                             'label': label, 'final': c, 'output': output}
+        tasks.append((source_file, out_dir + '/' + output, key))
+
+    removed = [entry['output'] for key, entry in manifest.items()
+               if key not in new_manifest or new_manifest[key]['output'] != entry['output']]
+    for output in removed:
+        if os.path.exists(out_dir + '/' + output):
+            os.remove(out_dir + '/' + output)
+
+    with ProcessPoolExecutor(workers) as executor:
+        for (_, _, key), digest in run_bounded(executor, tasks, window, _convert_and_hash_task):
+            new_manifest[key]['hash'] = digest
+
+    save_manifest(out_dir, new_manifest)
+
+    print('Unchanged:', unchanged, 'converted:', len(tasks), 'removed:', len(removed))
+    return new_manifest
+
+
+def _convert_and_hash_task(source_file, out_file, key):
+    return convert_and_hash_image(source_file, out_file)
+
+
+def pipeline(path, workers=None, window=256):
+    incremental_merge(path, workers, window)
     print('*DONE*')
 
 
 if __name__ == '__main__':
     if len(argv) < 2 or not os.path.exists(argv[1]):
-        print('usage:', argv[0], 'path/to/datasets', file=stderr)
+        print('usage:', argv[0], 'path/to/datasets [workers] [window]', file=stderr)
         exit(1)
 
-    pipeline(argv[1])
+    workers = int(argv[2]) if len(argv) > 2 else None
+    window = int(argv[3]) if len(argv) > 3 else 256
+
+    pipeline(argv[1], workers, window)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import os
+from concurrent.futures import ProcessPoolExecutor
+from sys import argv, stderr
+from PIL import Image
+import numpy as np
+
+_NUMBER_OF_CLASSES = 93
+
+# a packed data set is a directory with three .npy files:
+#   images.npy  - uint8 array of shape (N, height, width, 3), sorted by class
+#   labels.npy  - uint8 array of shape (N,)
+#   offsets.npy - int64 array of shape (_NUMBER_OF_CLASSES + 1,), images of class c are images[offsets[c]:offsets[c + 1]]
+_IMAGES_FILE = 'images.npy'
+_LABELS_FILE = 'labels.npy'
+_OFFSETS_FILE = 'offsets.npy'
+
+# optional, created by dedup.py in the data folder and copied to the packed data set:
+#   groups.npy  - int64 array of shape (N,), near-duplicate images share the group id
+_GROUPS_FILE = 'groups.npy'
+
+
+def is_packed_dataset(path):
+    return os.path.isfile(os.path.join(path, _IMAGES_FILE))
+
+
+def list_class_files(path):
+    files = []
+    for c in range(_NUMBER_OF_CLASSES):
+        dir_name = path + '/' + format(c, '05d')
+        files.append(sorted(dir_name + '/' + f for f in os.listdir(dir_name)))
+
+    return files
+
+
+def load_resized(file, size):
+    with Image.open(file) as img:
+        return np.array(img.convert('RGB').resize(size, Image.LANCZOS))
+
+
+def pack_dataset(path, out_path, size=(32, 32), workers=None):
+    """Packs the data folder created by merge_datasets.py into one contiguous array of resized images."""
+    files = list_class_files(path)
+    counts = [len(f) for f in files]
+    offsets = np.zeros(_NUMBER_OF_CLASSES + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    os.makedirs(out_path, exist_ok=True)
+    images = np.lib.format.open_memmap(os.path.join(out_path, _IMAGES_FILE), mode='w+', dtype=np.uint8,
+                                       shape=(int(offsets[-1]), size[1], size[0], 3))
+    labels = np.lib.format.open_memmap(os.path.join(out_path, _LABELS_FILE), mode='w+', dtype=np.uint8,
+                                       shape=(int(offsets[-1]),))
+
+    with ProcessPoolExecutor(workers) as executor:
+        for c in range(_NUMBER_OF_CLASSES):
+            print(c, '/', str(_NUMBER_OF_CLASSES - 1))
+            for i, image in enumerate(executor.map(load_resized, files[c], [size] * counts[c], chunksize=64)):
+                images[offsets[c] + i] = image
+            labels[offsets[c]:offsets[c + 1]] = c
+
+    images.flush()
+    labels.flush()
+    np.save(os.path.join(out_path, _OFFSETS_FILE), offsets)
+
+    groups = load_groups(path)
+    if groups is not None:
+        save_groups(out_path, groups)
+
+    print('Packed', offsets[-1], 'images to', out_path)
+
+
+def load_packed_dataset(path):
+    """Opens a packed data set without reading it, the arrays are read-only memory maps."""
+    images = np.load(os.path.join(path, _IMAGES_FILE), mmap_mode='r')
+    labels = np.load(os.path.join(path, _LABELS_FILE), mmap_mode='r')
+    offsets = np.load(os.path.join(path, _OFFSETS_FILE))
+
+    return images, labels, offsets
+
+
+def load_groups(path):
+    """Returns the near-duplicate group of every image (in the order of list_class_files) or None."""
+    groups_file = os.path.join(path, _GROUPS_FILE)
+    return np.load(groups_file) if os.path.isfile(groups_file) else None
+
+
+def save_groups(path, groups):
+    np.save(os.path.join(path, _GROUPS_FILE), np.asarray(groups, dtype=np.int64))
+
+
+def split_by_class(images, offsets):
+    return [images[offsets[c]:offsets[c + 1]] for c in range(_NUMBER_OF_CLASSES)]
+
+
+if __name__ == '__main__':
+    if len(argv) < 3 or not os.path.exists(argv[1]):
+        print('usage:', argv[0], 'path/to/data path/to/packed [size] [workers]', file=stderr)
+        exit(1)
+
+    size = int(argv[3]) if len(argv) > 3 else 32
+    workers = int(argv[4]) if len(argv) > 4 else None
+
+    pack_dataset(argv[1], argv[2], (size, size), workers)
@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+import numpy as np
+import preprocessing
+
+
+def model_digest(model_files):
+    """sha256 of the contents of the model file (or of the model files of an ensemble), a retrained model saved
+    under the same name gets a new digest."""
+    digest = hashlib.sha256()
+    for model_file in [model_files] if isinstance(model_files, str) else model_files:
+        with open(model_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """Caches the predictions of one model (or ensemble) for preprocessed images. The key of an image is a hash of its
+    preprocessed pixels together with the model digest and the preprocessing settings, so the cache never returns
+    predictions of another model or another preprocessing.
+
+    Lookups go to an in-memory LRU of memory_entries predictions first and then to an SQLite database, once the
+    database holds more than max_bytes of predictions the least recently used ones are deleted."""
+
+    def __init__(self, db_file, model_files, input_shape, grayscale, equalization, memory_entries=100000,
+                 max_bytes=256 * 2 ** 20):
+        if os.path.dirname(db_file):
+            os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self.db = sqlite3.connect(db_file)
+        self.db.execute('CREATE TABLE IF NOT EXISTS predictions '
+                        '(key BLOB PRIMARY KEY, predictions BLOB NOT NULL, last_used REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS model_digests '
+                        '(path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, digest TEXT NOT NULL)')
+
+        model_files = [model_files] if isinstance(model_files, str) else model_files
+        configuration = {'model': [self._model_digest(model_file) for model_file in model_files],
+                         'input_shape': list(input_shape), 'grayscale': bool(grayscale),
+                         'equalization': bool(equalization), 'version': preprocessing.VERSION}
+        self.prefix = hashlib.sha256(json.dumps(configuration, sort_keys=True).encode()).digest()
+        self.memory = OrderedDict()
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        # size of the stored predictions, counted up on every insert so the table is only scanned again when the
+        # count crosses max_bytes, replaced rows make it an overestimate until then
+        self.bytes = self.db.execute('SELECT TOTAL(LENGTH(predictions)) FROM predictions').fetchone()[0]
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _model_digest(self, model_file):
+        """model_digest of the file, the whole file is only hashed again when its size or mtime changed."""
+        path = os.path.abspath(model_file)
+        stat = os.stat(path)
+        row = self.db.execute('SELECT digest FROM model_digests WHERE path = ? AND size = ? AND mtime = ?',
+                              (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+
+        digest = model_digest(path)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO model_digests VALUES (?, ?, ?, ?)',
+                            (path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    def key(self, image):
+        return hashlib.sha256(self.prefix + np.ascontiguousarray(image).tobytes()).digest()
+
+    def get_many(self, keys):
+        """Returns a list with the cached predictions of every key or None where it is not cached."""
+        results = [None] * len(keys)
+        missing = []
+
+        for i, key in enumerate(keys):
+            predictions = self.memory.get(key)
+            if predictions is None:
+                missing.append(i)
+            else:
+                self.memory.move_to_end(key)
+                results[i] = predictions
+                self.memory_hits += 1
+
+        if missing:
+            found = {}
+            # sqlite limits the number of parameters of one statement
+            for start in range(0, len(missing), 500):
+                chunk = [keys[i] for i in missing[start:start + 500]]
+                rows = self.db.execute('SELECT key, predictions FROM predictions WHERE key IN (%s)'
+                                       % ','.join('?' * len(chunk)), chunk)
+                found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows)
+
+            if found:
+                now = time.time()
+                with self.db:
+                    self.db.executemany('UPDATE predictions SET last_used = ? WHERE key = ?',
+                                        [(now, key) for key in found])
+
+            for i in missing:
+                predictions = found.get(keys[i])
+                if predictions is None:
+                    self.misses += 1
+                else:
+                    self._remember(keys[i], predictions)
+                    results[i] = predictions
+                    self.disk_hits += 1
+
+        return results
+
+    def put_many(self, keys, predictions):
+        predictions = np.asarray(predictions, dtype=np.float32)
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+                                [(key, p.tobytes(), now) for key, p in zip(keys, predictions)])
+        for key, p in zip(keys, predictions):
+            self._remember(key, p)
+
+        self.bytes += predictions.nbytes
+        if self.bytes > self.max_bytes:
+            self.evict()
+
+    def _remember(self, key, predictions):
+        self.memory[key] = predictions
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def evict(self):
+        count, size = self.db.execute('SELECT COUNT(*), TOTAL(LENGTH(predictions)) FROM predictions').fetchone()
+        self.bytes = size
+        if size <= self.max_bytes:
+            return
+
+        # all entries of one model have the same size, delete the oldest ones down to 90 % of the limit
+        excess = count - int(0.9 * self.max_bytes / (size / count))
+        with self.db:
+            self.db.execute('DELETE FROM predictions WHERE key IN '
+                            '(SELECT key FROM predictions ORDER BY last_used LIMIT ?)', (excess,))
+        self.bytes = size - excess * size / count
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {'lookups': lookups, 'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else None}
+
+    def close(self):
+        self.db.close()
+
+
+def predict_cached(model, images, cache, batch_size=256):
+    """model.predict for the images that are not in the cache, the others are answered from the cache. The model is
+    not called at all when every image is cached, see LazyModel."""
+    keys = [cache.key(image) for image in images]
+    cached = cache.get_many(keys)
+    missing = [i for i, predictions in enumerate(cached) if predictions is None]
+
+    if missing:
+        predictions = model.predict(images[missing], batch_size=batch_size)
+        cache.put_many([keys[i] for i in missing], predictions)
+        for i, p in zip(missing, predictions):
+            cached[i] = p
+
+    return np.stack(cached, axis=0)
+
+
+class LazyModel:
+    """Loads the model on the first predict call, so a run answered completely from the cache never imports
+    tensorflow or reads the model."""
+
+    def __init__(self, load):
+        self.load = load
+        self.model = None
+
+    def predict(self, images, batch_size=32):
+        if self.model is None:
+            self.model = self.load()
+        return self.model.predict(images, batch_size=batch_size)
@@ -0,0 +1,111 @@
+from PIL import Image
+import numpy as np
+
+# All methods in this module take and return a batch of images as numpy array of shape (N, height, width[, channels])
+
+# bump when the output of the methods below changes, invalidates the cached data sets
+VERSION = 2
+
+_GRAYSCALE_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+# number of images equalized at once, bounds the size of the temporary arrays
+_EQUALIZATION_CHUNK = 4096
+
+
+def resize(images, size, method=Image.LANCZOS):
+    """Resizes a batch (or a list of differently sized images) to size = (width, height), returns uint8 RGB images."""
+    if isinstance(images, np.ndarray) and images.ndim == 4 and images.shape[2:0:-1] == tuple(size):
+        return images
+
+    resized = np.empty((len(images), size[1], size[0], 3), dtype=np.uint8)
+    for i, image in enumerate(images):
+        if image.shape[1::-1] == tuple(size) and image.ndim == 3 and image.shape[2] == 3:
+            resized[i] = image
+        else:
+            resized[i] = np.asarray(Image.fromarray(image).convert('RGB').resize(size, method))
+
+    return resized
+
+
+def to_grayscale(images):
+    return np.dot(images, _GRAYSCALE_WEIGHTS)
+
+
+def normalize(images, dtype=np.float32):
+    """Scales images to [0, 1], input of the given floating point dtype is modified in place."""
+    if images.dtype != dtype:
+        images = images.astype(dtype)
+
+    images *= images.dtype.type(1 / 255.0)
+    return images
+
+
+def to_uint8(images):
+    """Rounds grayscale or equalized images back to uint8, a quarter of the memory of float32."""
+    if images.dtype == np.uint8:
+        return images
+
+    return np.clip(np.rint(images), 0, 255).astype(np.uint8)
+
+
+def image_histogram_equalization(images, number_bins=256):
+    """Per image histogram equalization of the whole batch, same as np.histogram and np.interp applied to each image."""
+    images = np.asarray(images)
+    equalized = np.empty(images.shape, dtype=np.float32)
+
+    for start in range(0, len(images), _EQUALIZATION_CHUNK):
+        end = start + _EQUALIZATION_CHUNK
+        equalized[start:end] = _equalize(images[start:end].reshape(len(images[start:end]), -1),
+                                         number_bins).reshape(images[start:end].shape)
+
+    return equalized
+
+
+def _equalize(flat, number_bins):
+    n = flat.shape[0]
+    rows = np.arange(n)[:, np.newaxis]
+
+    flat = flat.astype(np.float32, copy=False)
+    low = flat.min(axis=1)
+    high = flat.max(axis=1)
+
+    # np.histogram widens the range of constant images by 0.5 on both sides
+    constant = low == high
+    low = np.where(constant, low - 0.5, low)
+    high = np.where(constant, high + 0.5, high)
+
+    # position of each pixel in units of bins, the last edge belongs to the last bin
+    positions = (flat - low[:, np.newaxis]) * (number_bins / (high - low))[:, np.newaxis]
+    index = np.minimum(positions.astype(np.int32), number_bins - 1)
+
+    histogram = np.bincount((index + rows * number_bins).ravel(), minlength=n * number_bins).reshape(n, number_bins)
+    cdf = np.cumsum(histogram, axis=1).astype(np.float32)
+    cdf *= 255 / cdf[:, -1:]
+
+    # linear interpolation between the left bin edges, values past the last left edge map to cdf[-1]
+    following = np.minimum(index + 1, number_bins - 1)
+    start = cdf[rows, index]
+    return start + (positions - index) * (cdf[rows, following] - start)
+
+
+def preprocess(images, size, grayscale=False, equalization=False, dtype=np.float32):
+    """Full preprocessing of a batch, returns images of shape (N, height, width, 1 if grayscale else 3).
+
+    The images are normalized to dtype, with dtype=np.uint8 they are left in [0, 255] to be normalized per batch."""
+    images = resize(images, size)
+
+    if grayscale:
+        images = to_grayscale(images)
+
+    if equalization:
+        images = image_histogram_equalization(images)
+
+    if dtype == np.uint8:
+        images = to_uint8(images)
+    else:
+        images = normalize(images, dtype)
+
+    if grayscale:
+        images = np.expand_dims(images, 3)
+
+    return images
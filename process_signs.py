@@ -2,6 +2,7 @@ from PIL import Image
 import numpy as np
 import imgaug as ia
 from imgaug import augmenters as iaa
+import preprocessing
 
 
 number_of_classes = 93
@@ -80,7 +81,7 @@ def flip_vertically(image):
     return np.array(img.transpose(Image.FLIP_TOP_BOTTOM))
 
 
-def resize(image, size, method=Image.ANTIALIAS):
+def resize(image, size, method=Image.LANCZOS):
     img = Image.fromarray(image)
     return np.array(img.resize(size, method))
 
@@ -94,27 +95,17 @@ def rotate180(image):
     return rotate(image, 180)
 
 
+# single image versions of the batch methods in preprocessing.py
 def to_grayscale(image):
-    return 0.299 * image[:, :, 0] + 0.587 * image[:, :, 1] + 0.114 * image[:, :, 2]
+    return preprocessing.to_grayscale(image[np.newaxis])[0]
 
 
 def normalize(image):
-    return image / 255.0
+    return preprocessing.normalize(image[np.newaxis].astype(np.float32))[0]
 
 
 def image_histogram_equalization(image, number_bins=256):
-    # from http://www.janeriksolem.net/2009/06/histogram-equalization-with-python-and.html
-    # taken from https://stackoverflow.com/a/28520445
-
-    # get image histogram
-    image_histogram, bins = np.histogram(image.flatten(), number_bins, density=True)
-    cdf = image_histogram.cumsum() # cumulative distribution function
-    cdf = 255 * cdf / cdf[-1] # normalize
-
-    # use linear interpolation of cdf to find new pixel values
-    image_equalized = np.interp(image.flatten(), bins[:-1], cdf)
-
-    return image_equalized.reshape(image.shape)
+    return preprocessing.image_histogram_equalization(image[np.newaxis], number_bins)[0]
 
 
 # an example augmentation sequence using imgaug library
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+import argparse
+import io
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from PIL import Image
+import numpy as np
+import tensorflow as tf
+from label_image import read_labels, top_k_results
+import preprocessing
+
+
+class MicroBatcher:
+    """Collects concurrent requests into batches of at most max_batch_size images, waiting at most max_wait seconds
+    for a batch to fill up, and runs one model.predict per batch on a single background thread."""
+
+    def __init__(self, model, input_shape, grayscale=False, equalize=False, max_batch_size=64, max_wait=0.005,
+                 max_queue_size=1024, k=5):
+        self.model = model
+        self.input_shape = input_shape
+        self.grayscale = grayscale
+        self.equalize = equalize
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.k = k
+
+        self.requests = queue.Queue(max_queue_size)
+        self.latencies = deque(maxlen=10000)
+        self.batch_sizes = deque(maxlen=10000)
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+        # keras models of TF 1.x have to be used from the graph and session they were loaded into
+        self.model._make_predict_function()
+        self.graph = tf.get_default_graph()
+        self.session = tf.keras.backend.get_session()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        """Queues one uint8 image, returns a future of its top k results or None if the queue is full."""
+        future = Future()
+        try:
+            self.requests.put_nowait((image, future, time.perf_counter()))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return None
+
+        return future
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        with self.graph.as_default(), self.session.as_default():
+            while True:
+                batch = self._next_batch()
+                try:
+                    images = preprocessing.preprocess(np.stack([image for image, _, _ in batch]), self.input_shape,
+                                                      self.grayscale, self.equalize)
+                    results = top_k_results(self.model.predict(images, batch_size=len(batch)), self.k)
+                except Exception as e:
+                    for _, future, _ in batch:
+                        future.set_exception(e)
+                    continue
+
+                end = time.perf_counter()
+                with self.lock:
+                    self.batch_sizes.append(len(batch))
+                    for (_, future, start), result in zip(batch, results):
+                        self.latencies.append(end - start)
+                        future.set_result(result)
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            rejected = self.rejected
+
+        stats = {'requests': len(latencies), 'rejected': rejected, 'queued': self.requests.qsize()}
+        if len(latencies):
+            stats['latency_ms'] = {f'p{p}': float(np.percentile(latencies, p)) for p in (50, 90, 95, 99)}
+            stats['mean_batch_size'] = float(batch_sizes.mean())
+
+        return stats
+
+
+def make_handler(batcher, labels):
+    class ClassificationHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/classify':
+                self._send(404, {'error': 'not found'})
+                return
+
+            try:
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with Image.open(io.BytesIO(body)) as img:
+                    image = preprocessing.resize([np.array(img)], batcher.input_shape)[0]
+            except Exception as e:
+                self._send(400, {'error': str(e)})
+                return
+
+            future = batcher.submit(image)
+            if future is None:
+                self._send(503, {'error': 'too many requests'})
+                return
+
+            try:
+                result = future.result()
+            except Exception as e:
+                self._send(500, {'error': str(e)})
+                return
+
+            self._send(200, {'results': [{'class': i, 'label': labels[i], 'probability': p} for i, p in result]})
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send(200, batcher.stats())
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def _send(self, code, content):
+            body = json.dumps(content, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ClassificationHandler
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('unix', 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='models/model.h5', help='model to be executed')
+    parser.add_argument('--labels', default='labels.txt', help='name of file containing labels')
+    parser.add_argument('--grayscale', action='store_true', help='convert to grayscale')
+    parser.add_argument('--equalize', action='store_true', help='apply histogram equalization')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8500, help='port to listen on')
+    parser.add_argument('--socket', help='listen on this unix socket instead of a TCP port')
+    parser.add_argument('--max-batch-size', type=int, default=64, help='maximum number of images in one batch')
+    parser.add_argument('--max-wait', type=float, default=5, help='maximum time to wait for a batch to fill in ms')
+    parser.add_argument('--max-queue-size', type=int, default=1024,
+                        help='number of waiting requests after which new ones are rejected')
+    parser.add_argument('--top-k', type=int, default=5, help='number of results for every image')
+    args = parser.parse_args()
+
+    labels = read_labels(args.labels)
+    model = tf.keras.models.load_model(args.model)
+
+    batcher = MicroBatcher(model, (32, 32), args.grayscale, args.equalize, args.max_batch_size, args.max_wait / 1000,
+                           args.max_queue_size, args.top_k)
+    handler = make_handler(batcher, labels)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, handler)
+        print('Listening on', args.socket)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        print('Listening on', args.host + ':' + str(args.port))
+
+    server.serve_forever()
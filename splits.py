@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import numpy as np
+from dataset_cache import dataset_fingerprint
+
+_SPLITS_FILE = 'splits.npz'
+
+
+def stratified_split(labels, ratios, groups=None, seed=123):
+    """Splits the images into len(ratios) + 1 index arrays, the i-th one gets ratios[i] of every class and the last
+    one the rest. Images of one group (for example a track of near-duplicate frames) always end up in one split."""
+    labels = np.asarray(labels)
+    random_state = np.random.RandomState(seed)
+    splits = [[] for _ in range(len(ratios) + 1)]
+
+    order = np.argsort(labels, kind='stable')
+    classes, starts = np.unique(labels[order], return_index=True)
+
+    for members in np.split(order, starts[1:]):
+        if groups is None:
+            units = [members[i:i + 1] for i in random_state.permutation(len(members))]
+        else:
+            member_groups = np.asarray(groups)[members]
+            unique_groups = np.unique(member_groups)
+            units = [members[member_groups == g] for g in unique_groups[random_state.permutation(len(unique_groups))]]
+
+        targets = [int(len(members) * ratio) for ratio in ratios]
+        split, taken = 0, 0
+        for unit in units:
+            while split < len(targets) and taken >= targets[split]:
+                split, taken = split + 1, 0
+            splits[split].append(unit)
+            taken += len(unit)
+
+    return [np.sort(np.concatenate(s)) if s else np.empty(0, dtype=np.int64) for s in splits]
+
+
+def load_or_create_splits(path, labels, ratios, groups=None, seed=123):
+    """Reads the splits saved next to the data set, creates and saves them if they do not exist or were made for
+    other files, labels, groups or ratios."""
+    splits_file = os.path.join(path, _SPLITS_FILE)
+    configuration = {'dataset': dataset_fingerprint(path), 'seed': seed, 'ratios': list(ratios)}
+    digest = hashlib.sha256(json.dumps(configuration, sort_keys=True).encode())
+    digest.update(np.ascontiguousarray(labels, dtype=np.int64).tobytes())
+    if groups is not None:
+        digest.update(b'groups')
+        digest.update(np.ascontiguousarray(groups, dtype=np.int64).tobytes())
+    key = digest.hexdigest()
+
+    if os.path.isfile(splits_file):
+        saved = np.load(splits_file)
+        if 'key' in saved.files and str(saved['key']) == key:
+            print('Using splits from', splits_file)
+            return [saved[f'split_{i}'] for i in range(len(ratios) + 1)]
+
+    splits = stratified_split(labels, ratios, groups, seed)
+    np.savez(splits_file, key=key, **{f'split_{i}': s for i, s in enumerate(splits)})
+    print('Saved splits to', splits_file)
+
+    return splits
+
+
+def check_splits(**sizes):
+    """Raises a ValueError naming the empty splits, keras fails on them with much less clear errors."""
+    empty = [name for name, size in sizes.items() if size == 0]
+    if empty:
+        raise ValueError(f'the {" and ".join(empty)} split of the data set is empty, it has too few images')
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+
+_RESULT_FIELDS = ['conv_depth', 'dense_depth', 'parameters', 'wall_time', 'images_per_second', 'validation_accuracy']
+
+
+def prepare_dataset(path, work_dir, input_shape, grayscale, equalization, validation_ratio=0.1):
+    """Preprocesses the data set once and saves it to work_dir as .npy files which all workers memory-map."""
+    from train import read_dataset, split_images, list_of_lists_to_numpy_array_images_and_labels
+    import preprocessing
+
+    images = [list(preprocessing.resize(c, input_shape)) for c in read_dataset(path)]
+    validation_images, train_images = split_images(images, validation_ratio)
+    del images
+
+    os.makedirs(work_dir, exist_ok=True)
+    for name, split in [('train', train_images), ('validation', validation_images)]:
+        images, labels = list_of_lists_to_numpy_array_images_and_labels(split)
+        np.save(os.path.join(work_dir, name + '_images.npy'),
+                preprocessing.preprocess(images, input_shape, grayscale, equalization))
+        np.save(os.path.join(work_dir, name + '_labels.npy'), np.array(labels, dtype=np.int32))
+
+
+def _load(work_dir, name):
+    return (np.load(os.path.join(work_dir, name + '_images.npy'), mmap_mode='r'),
+            np.load(os.path.join(work_dir, name + '_labels.npy')))
+
+
+def train_configuration(work_dir, conv_depth, dense_depth, epochs, batch_size, threads):
+    """Trains one configuration, runs in its own worker process."""
+    import tensorflow as tf
+    from tensorflow import keras
+    from build_model import build_model
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+    keras.backend.set_session(tf.Session(config=config))
+
+    train_images, train_labels = _load(work_dir, 'train')
+    validation_images, validation_labels = _load(work_dir, 'validation')
+
+    model = build_model(train_images.shape[1:], conv_depth, dense_depth, keras.optimizers.Adam(),
+                        keras.losses.sparse_categorical_crossentropy)
+
+    start = time.perf_counter()
+    model.fit(train_images, train_labels, batch_size=batch_size, epochs=epochs, shuffle='batch', verbose=0)
+    wall_time = time.perf_counter() - start
+
+    predictions = model.predict(validation_images, batch_size=1024)
+    accuracy = float(np.mean(np.argmax(predictions, axis=1) == validation_labels))
+
+    return {'conv_depth': conv_depth, 'dense_depth': dense_depth, 'parameters': model.count_params(),
+            'wall_time': wall_time, 'images_per_second': epochs * len(train_images) / wall_time,
+            'validation_accuracy': accuracy}
+
+
+def run_sweep(work_dir, configurations, epochs, batch_size, jobs, threads, output):
+    # tensorflow is not fork-safe, every worker starts a fresh interpreter
+    with ProcessPoolExecutor(jobs, mp_context=get_context('spawn')) as executor, open(output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, _RESULT_FIELDS)
+        writer.writeheader()
+
+        futures = [executor.submit(train_configuration, work_dir, conv_depth, dense_depth, epochs, batch_size,
+                                   threads) for conv_depth, dense_depth in configurations]
+
+        for future in futures:
+            result = future.result()
+            writer.writerow(result)
+            f.flush()
+            print(' '.join(f'{field}={result[field]}' for field in _RESULT_FIELDS))
+
+
+if __name__ == '__main__':
+    from build_model import model_configurations
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='path to the data folder or a packed data set')
+    parser.add_argument('--work-dir', default='sweep', help='directory for the preprocessed data set')
+    parser.add_argument('--output', default='sweep.csv', help='results table')
+    parser.add_argument('--jobs', type=int, default=4, help='number of configurations trained at once')
+    parser.add_argument('--threads', type=int, default=1, help='number of threads of every job')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--grayscale', action='store_true', help='convert to grayscale')
+    parser.add_argument('--equalize', action='store_true', help='apply histogram equalization')
+    args = parser.parse_args()
+
+    print('Preparing data set')
+    prepare_dataset(args.path, args.work_dir, (32, 32), args.grayscale, args.equalize)
+
+    run_sweep(args.work_dir, model_configurations(), args.epochs, args.batch_size, args.jobs, args.threads,
+              args.output)
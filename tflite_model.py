@@ -0,0 +1,48 @@
+import numpy as np
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    Interpreter = None
+
+
+class TFLiteModel:
+    """Runs an exported .tflite model with the same predict method as a keras model."""
+
+    def __init__(self, model_file, num_threads=None):
+        if Interpreter is not None:
+            self.interpreter = Interpreter(model_path=model_file, num_threads=num_threads)
+        else:
+            import tensorflow as tf
+            self.interpreter = tf.lite.Interpreter(model_path=model_file)
+
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+
+    @property
+    def input_shape(self):
+        return (None,) + tuple(self.input['shape'][1:])
+
+    def predict(self, images, batch_size=None):
+        images = np.asarray(images, dtype=np.float32)
+        if self.batch_size != len(images):
+            self.interpreter.resize_tensor_input(self.input['index'], (len(images),) + tuple(self.input['shape'][1:]))
+            self.interpreter.allocate_tensors()
+            self.input = self.interpreter.get_input_details()[0]
+            self.output = self.interpreter.get_output_details()[0]
+            self.batch_size = len(images)
+
+        scale, zero_point = self.input['quantization']
+        if scale:
+            images = np.round(images / scale + zero_point).astype(self.input['dtype'])
+
+        self.interpreter.set_tensor(self.input['index'], images)
+        self.interpreter.invoke()
+        predictions = self.interpreter.get_tensor(self.output['index'])
+
+        scale, zero_point = self.output['quantization']
+        if scale:
+            predictions = (predictions.astype(np.float32) - zero_point) * scale
+
+        return predictions
@@ -1,32 +1,37 @@
 #!/usr/bin/env python3
 import os
-from sys import argv, stderr
-from PIL import Image, ImageOps
+import argparse
+import contextlib
+from sys import stderr
+from PIL import Image
 import numpy as np
 import tensorflow as tf
 from tensorflow import keras
 import random as rnd
 from datetime import datetime
+from packed_dataset import is_packed_dataset, load_packed_dataset, load_groups, split_by_class
+import preprocessing
+import input_pipeline
+from splits import check_splits, load_or_create_splits
+from checkpoints import PeriodicCheckpoint, latest_checkpoint, load_checkpoint
+from distributed import ThroughputCallback, cluster_size_and_index
+from instrumentation import Tracer, step_timing_callback
+from dataset_cache import DatasetCache, cache_key
+import distillation
 
 _NUMBER_OF_CLASSES = 93
 
-_flip_horizontally = [(0, 0), (1, 1), (3, 3), (7, 7), (8, 8), (34, 35), (39, 39), (41, 42), (43, 44), (45, 45),
-                      (47, 47), (48, 49), (50, 50), (51, 51), (54, 54), (62, 62), (63, 63), (65, 65), (67, 67),
-                      (68, 69), (70, 71), (72, 72), (77, 77), (80, 80), (82, 82), (83, 84), (86, 86), (88, 88),
-                      (92, 92)]
-
-_flip_vertically = [(1, 1), (7, 7), (8, 8), (24, 24), (39, 39), (74, 74), (75, 75), (83, 83), (84, 84)]
-
-_rotate_180 = [(2, 2), (38, 38)]
-
-_rotate_arrows = [(67, 0), (73, 90), (74, 270), (75, 135), (76, 225)]
-
 rnd.seed(123)
 tf.set_random_seed(123)
 np.random.seed(123)
 
 
 def read_dataset(path: str) -> list:
+    if is_packed_dataset(path):
+        print('Opening packed data set')
+        images, _, offsets = load_packed_dataset(path)
+        return split_by_class(images, offsets)
+
     images = [[] for _ in range(_NUMBER_OF_CLASSES)]
 
     print('Loading data set')
@@ -34,7 +39,7 @@ def read_dataset(path: str) -> list:
         print(c, '/', str(_NUMBER_OF_CLASSES - 1))
         dir_name = path + '/' + format(c, '05d')
 
-        for f in os.listdir(dir_name):
+        for f in sorted(os.listdir(dir_name)):
             img = Image.open(dir_name + '/' + f)
             images[c].append(np.array(img))
 
@@ -61,7 +66,8 @@ def build_model(input_shape: tuple):
     model.add(keras.layers.Dropout(0.5))
     model.add(keras.layers.Dense(800, activation=keras.activations.relu, name='dense_2'))
     model.add(keras.layers.Dropout(0.5))
-    model.add(keras.layers.Dense(_NUMBER_OF_CLASSES, activation=keras.activations.softmax, name='dense_softmax'))
+    model.add(keras.layers.Dense(_NUMBER_OF_CLASSES, activation=keras.activations.softmax, name='dense_softmax',
+                                 dtype='float32'))
 
     model.compile(optimizer=keras.optimizers.Adam(), loss=keras.losses.sparse_categorical_crossentropy,
                   metrics=['sparse_categorical_accuracy'])
@@ -69,63 +75,6 @@ def build_model(input_shape: tuple):
     return model
 
 
-def augment_images(images):
-    images = augment(images, _flip_horizontally, flip_horizontally)
-    images = augment(images, _flip_vertically, flip_vertically)
-    images = augment(images, _rotate_180, rotate180)
-
-    return images
-
-
-def augment(images, list_of_pairs, method):
-    new_images = [[] for _ in range(_NUMBER_OF_CLASSES)]
-
-    for first, second in list_of_pairs:
-        for image in images[first]:
-            new_images[second].append(method(image))
-
-        if first != second:
-            for image in images[second]:
-                new_images[first].append(method(image))
-
-    return [images[c] + new_images[c] for c in range(_NUMBER_OF_CLASSES)]
-
-
-def flip_horizontally(image):
-    return np.fliplr(image)
-
-
-def flip_vertically(image):
-    return np.flipud(image)
-
-
-def resize(image, size, method=Image.ANTIALIAS):
-    img = Image.fromarray(image)
-    return np.array(img.resize(size, method))
-
-
-def rotate180(image):
-    return np.rot90(image, 2)
-
-
-def to_grayscale(image):
-    return 0.299 * image[:, :, 0] + 0.587 * image[:, :, 1] + 0.114 * image[:, :, 2]
-
-
-def normalize(image):
-    return image / 255.0
-
-
-def image_histogram_equalization(image, number_bins=256):
-    image_histogram, bins = np.histogram(image.flatten(), number_bins, density=True)
-    cdf = image_histogram.cumsum()
-    cdf = 255 * cdf / cdf[-1]
-
-    image_equalized = np.interp(image.flatten(), bins[:-1], cdf)
-
-    return image_equalized.reshape(image.shape)
-
-
 def list_of_lists_to_numpy_array_images_and_labels(lst):
     images = []
     labels = []
@@ -153,12 +102,104 @@ def split_images(images, ratio):
     return a, b
 
 
+def load_images(path, input_shape, grayscale, equalization, augment, cache=None, tracer=None):
+    """One contiguous uint8 array of preprocessed (only resized when they are augmented on the fly) but not yet
+    normalized images sorted by class and their labels."""
+    tracer = tracer or Tracer()
+
+    if augment:
+        grayscale, equalization = False, False
+
+    if cache is not None:
+        key = cache_key(path, input_shape, grayscale, equalization, 'resized' if augment else 'preprocessed')
+        cached = cache.load(key)
+        if cached is not None:
+            print('Using cached data set', key)
+            images, offsets = cached
+            return images, np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    with tracer.stage('read'):
+        images = read_dataset(path)
+    if not sum(len(c) for c in images):
+        raise ValueError(f'no images found in {path}')
+
+    print('Resizing images')
+    with tracer.stage('resize', sum(len(c) for c in images)):
+        resized = [preprocessing.resize(c, input_shape) for c in images]
+    offsets = np.cumsum([0] + [len(c) for c in resized])
+    del images
+
+    if augment:
+        images = np.concatenate(resized)
+    else:
+        print('Preprocessing images')
+        images = None
+        for c in range(len(resized)):
+            preprocessed = resized[c]
+            if grayscale:
+                with tracer.stage('grayscale', len(preprocessed)):
+                    preprocessed = np.expand_dims(preprocessing.to_grayscale(preprocessed), 3)
+            if equalization:
+                with tracer.stage('equalize', len(preprocessed)):
+                    preprocessed = preprocessing.image_histogram_equalization(preprocessed)
+            preprocessed = preprocessing.to_uint8(preprocessed)
+
+            if images is None:
+                images = np.empty((offsets[-1],) + preprocessed.shape[1:], dtype=preprocessed.dtype)
+            images[offsets[c]:offsets[c + 1]] = preprocessed
+            resized[c] = None
+
+    if cache is not None:
+        cache.store(key, images, offsets)
+
+    return images, np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='path to the data folder or a packed data set')
+    parser.add_argument('grayscale', help='True to convert images to grayscale')
+    parser.add_argument('hist_equalization', help='True to apply histogram equalization')
+    parser.add_argument('augment', help='True to augment the training images')
+    parser.add_argument('--stream', action='store_true',
+                        help='stream the data set through a tf.data pipeline instead of loading it to memory')
+    parser.add_argument('--shuffle-buffer', type=int, default=10000, help='shuffle buffer size of the streaming mode')
+    parser.add_argument('--workers', type=int, default=4, help='number of augmentation worker processes')
+    parser.add_argument('--cache-dir', help='cache the preprocessed data set in this directory')
+    parser.add_argument('--cache-size', type=float, default=10, help='maximum size of the cache in GB')
+    parser.add_argument('--dtype', choices=['float32', 'float16', 'bfloat16'], default='float32',
+                        help='precision of the training, float16 and bfloat16 use a keras mixed precision policy')
+    parser.add_argument('--group-tracks', action='store_true',
+                        help='keep near-duplicate groups found by dedup.py in one split')
+    parser.add_argument('--checkpoint-dir', help='where checkpoints are saved, path/checkpoints by default')
+    parser.add_argument('--checkpoint-steps', type=int, help='save a checkpoint every this many batches')
+    parser.add_argument('--checkpoint-minutes', type=float, help='save a checkpoint every this many minutes')
+    parser.add_argument('--keep-checkpoints', type=int, default=3, help='number of newest checkpoints kept')
+    parser.add_argument('--resume', action='store_true', help='continue from the latest checkpoint')
+    parser.add_argument('--distributed', action='store_true',
+                        help='multi-worker data-parallel training of the cluster in TF_CONFIG, implies --stream')
+    parser.add_argument('--throughput-file', help='write the measured training throughput to this file')
+    parser.add_argument('--trace', help='write the timings of all stages to this JSON file')
+    parser.add_argument('--chrome-trace', help='write the timings of all stages as a chrome trace event file')
+    parser.add_argument('--teacher', help='distill this trained .h5 model into a smaller student model')
+    parser.add_argument('--student', default='1,2',
+                        help='conv_depth,dense_depth of the student, an architecture of build_model.py')
+    parser.add_argument('--temperature', type=float, default=4.0, help='softmax temperature of the distillation')
+    parser.add_argument('--alpha', type=float, default=0.7,
+                        help='weight of the soft teacher targets, the hard labels get 1 - alpha')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    if len(argv) != 5:
-        print('usage: ', argv[0], ' path/to/data grayscale hist_equalization augment', file=stderr)
-        exit(1)
+    args = parse_args()
 
-    path = argv[1]
+    # the strategy has to be created before any other tensorflow operation
+    strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy() if args.distributed else None
+    num_workers, worker_index = cluster_size_and_index() if args.distributed else (1, 0)
+    args.stream = args.stream or args.distributed
+
+    path = args.path
+    tracer = Tracer()
 
     testing_ratio = 0.1
     validation_ratio = 0.1
@@ -167,9 +208,9 @@ if __name__ == '__main__':
     epochs = 10
     input_shape = (32, 32)
 
-    do_grayscale = argv[2] == 'True'
-    do_equalization = argv[3] == 'True'
-    do_augment = argv[4] == 'True'
+    do_grayscale = args.grayscale == 'True'
+    do_equalization = args.hist_equalization == 'True'
+    do_augment = args.augment == 'True'
 
     print('Running with configuration:')
     print('Testing ratio:', testing_ratio)
@@ -180,54 +221,205 @@ if __name__ == '__main__':
     print('Grayscale:', do_grayscale)
     print('Histogram equalization:', do_equalization)
     print('Augment:', do_augment)
+    print('Streaming:', args.stream)
+    if args.teacher:
+        print('Teacher:', args.teacher)
+        print('Student:', args.student)
+    print('Precision:', args.dtype)
+    if args.distributed:
+        print('Worker:', worker_index, '/', num_workers)
     print()
 
-    images = read_dataset(path)
-
-    print('Resizing images')
-    images = [[resize(image, input_shape) for image in c] for c in images]
-
-    if do_grayscale:
-        print('Converting images to grayscale')
-        images = [[to_grayscale(image) for image in c] for c in images]
-
-    if do_equalization:
-        print('Applying histogram equalization')
-        images = [[image_histogram_equalization(image) for image in c] for c in images]
-
-    print('Normalizing images')
-    images = [[normalize(image) for image in c] for c in images]
-
-    test_images, train_images = split_images(images, testing_ratio)
-    del images
-
-    if do_augment:
-        print('Augmenting images')
-        train_images = augment_images(train_images)
-
-    validation_images, train_images = split_images(train_images, validation_ratio)
-
-    test_images, test_labels = list_of_lists_to_numpy_array_images_and_labels(test_images)
-    validation_images, validation_labels = list_of_lists_to_numpy_array_images_and_labels(validation_images)
-    train_images, train_labels = list_of_lists_to_numpy_array_images_and_labels(train_images)
-
-    if do_grayscale:
-        test_images = np.expand_dims(test_images, 3)
-        validation_images = np.expand_dims(validation_images, 3)
-        train_images = np.expand_dims(train_images, 3)
-
-    model = build_model(input_shape + (1 if do_grayscale else 3,))
-
-    history = model.fit(train_images, train_labels,
-                        validation_data=(validation_images, validation_labels),
-                        batch_size=batch_size,
-                        epochs=epochs)
-    print('\nhistory:', history.history)
-
-    eval = model.evaluate(test_images, test_labels)
-    print('\neval:', eval)
+    if args.teacher and (args.stream or do_augment):
+        print('The teacher predictions are computed once for the data set in memory, distillation can neither '
+              'stream nor augment the images', file=stderr)
+        exit(1)
 
-    name = datetime.now().strftime('%Y-%m-%d_%H:%M:%S') + '.h5'
+    checkpoint_dir = args.checkpoint_dir or os.path.join(path, 'checkpoints')
+    checkpointing = bool(args.checkpoint_steps or args.checkpoint_minutes or args.resume)
+    checkpoint = latest_checkpoint(checkpoint_dir) if args.resume else None
+    if args.resume and checkpoint is None:
+        print('No checkpoint in', checkpoint_dir, 'starting from scratch', file=stderr)
+
+    # images stay uint8 until they are batched, numpy has no bfloat16 so those batches are cast by keras
+    dtype = np.float16 if args.dtype == 'float16' else np.float32
+    if args.dtype != 'float32':
+        keras.mixed_precision.experimental.set_policy('mixed_' + args.dtype)
+
+    if args.stream:
+        with tracer.stage('read'):
+            items, load = input_pipeline.list_class_items(path)
+
+        with tracer.stage('split'):
+            test_items, train_items = split_images(items, testing_ratio)
+            validation_items, train_items = split_images(train_items, validation_ratio)
+        check_splits(test=sum(len(c) for c in test_items), validation=sum(len(c) for c in validation_items),
+                     training=sum(len(c) for c in train_items))
+
+        # every worker reads only its shard of the training and validation data
+        train_data, _ = input_pipeline.make_dataset(train_items, load, input_shape, do_grayscale, do_equalization,
+                                                    batch_size, shuffle_buffer=args.shuffle_buffer, repeat=True,
+                                                    num_shards=num_workers, shard_index=worker_index,
+                                                    augment=do_augment, dtype=dtype,
+                                                    auto_shard=not args.distributed)
+        validation_data, _ = input_pipeline.make_dataset(validation_items, load, input_shape, do_grayscale,
+                                                         do_equalization, batch_size, repeat=True,
+                                                         num_shards=num_workers, shard_index=worker_index,
+                                                         dtype=dtype, auto_shard=not args.distributed)
+        test_data, test_steps = input_pipeline.make_dataset(test_items, load, input_shape, do_grayscale,
+                                                            do_equalization, batch_size, dtype=dtype,
+                                                            auto_shard=not args.distributed)
+
+        # all workers have to run the same number of steps
+        train_steps = max(1, sum(len(c) for c in train_items) // num_workers // batch_size)
+        validation_steps = max(1, sum(len(c) for c in validation_items) // num_workers // batch_size)
+
+        with strategy.scope() if strategy else contextlib.nullcontext():
+            if checkpoint:
+                # the position in the tf.data pipeline is not saved, the interrupted epoch starts over
+                print('Resuming from', checkpoint)
+                model, state, _ = load_checkpoint(checkpoint)
+            else:
+                model = build_model(input_shape + (1 if do_grayscale else 3,))
+                state = {'epoch': 0, 'step': 0, 'global_step': 0}
+
+        callbacks = [ThroughputCallback(batch_size, num_workers, args.throughput_file),
+                     step_timing_callback(tracer, batch_size)]
+        if checkpointing and worker_index == 0:
+            callbacks.append(PeriodicCheckpoint(checkpoint_dir, [], args.checkpoint_steps, args.checkpoint_minutes,
+                                                args.keep_checkpoints, state['global_step']))
+
+        with tracer.stage('fit', (epochs - state['epoch']) * train_steps * batch_size * num_workers):
+            history = model.fit(train_data,
+                                steps_per_epoch=train_steps,
+                                validation_data=validation_data,
+                                validation_steps=validation_steps,
+                                epochs=epochs,
+                                initial_epoch=state['epoch'],
+                                callbacks=callbacks)
+        print('\nhistory:', history.history)
+
+        with tracer.stage('evaluate', sum(len(c) for c in test_items)):
+            eval = model.evaluate(test_data, steps=test_steps)
+        print('\neval:', eval)
+    else:
+        cache = DatasetCache(args.cache_dir, int(args.cache_size * 2 ** 30)) if args.cache_dir else None
+        images, labels = load_images(path, input_shape, do_grayscale, do_equalization, do_augment, cache, tracer)
+
+        groups = load_groups(path) if args.group_tracks else None
+        if groups is not None and len(groups) != len(labels):
+            print('Groups do not match the data set, run dedup.py again', file=stderr)
+            exit(1)
+
+        targets, custom_objects = labels, None
+        if args.teacher:
+            # the student learns the teacher predictions next to the labels, both are passed as the targets
+            with tracer.stage('teacher', len(labels)):
+                teacher_predictions = distillation.teacher_predictions(path, args.teacher, images, do_grayscale,
+                                                                       do_equalization)
+            targets = distillation.distillation_targets(labels,
+                                                        distillation.soften(teacher_predictions, args.temperature))
+            custom_objects = distillation.custom_objects(args.temperature, args.alpha)
+
+        if checkpoint:
+            print('Resuming from', checkpoint)
+            model, state, (test_indices, validation_indices, train_indices) = load_checkpoint(checkpoint,
+                                                                                              custom_objects)
+        else:
+            if args.teacher:
+                conv_depth, dense_depth = [int(d) for d in args.student.split(',')]
+                model = distillation.build_student(input_shape + (1 if do_grayscale else 3,), conv_depth,
+                                                   dense_depth, args.temperature, args.alpha)
+            else:
+                model = build_model(input_shape + (1 if do_grayscale else 3,))
+            state = {'epoch': 0, 'step': 0, 'global_step': 0}
+            with tracer.stage('split', len(labels)):
+                test_indices, validation_indices, train_indices = load_or_create_splits(
+                    path, labels, (testing_ratio, validation_ratio * (1 - testing_ratio)), groups)
+
+        check_splits(test=len(test_indices), validation=len(validation_indices), training=len(train_indices))
+        test_images, test_labels = images[test_indices], targets[test_indices]
+        validation_images, validation_labels = images[validation_indices], targets[validation_indices]
+
+        with tracer.stage('normalize', len(test_images) + len(validation_images)):
+            if do_augment:
+                test_images = preprocessing.preprocess(test_images, input_shape, do_grayscale, do_equalization,
+                                                       dtype)
+                validation_images = preprocessing.preprocess(validation_images, input_shape, do_grayscale,
+                                                             do_equalization, dtype)
+            else:
+                test_images = preprocessing.normalize(test_images, dtype)
+                validation_images = preprocessing.normalize(validation_images, dtype)
+
+        if do_augment:
+            # the training batches are augmented (and normalized) by the workers, their time is part of the steps
+            print('Augmenting images on the fly')
+
+        train_sequence = input_pipeline.TrainingSequence(images, targets, train_indices, batch_size, input_shape,
+                                                         do_grayscale, do_equalization, augment=do_augment,
+                                                         preprocess=do_augment, dtype=dtype)
+        train_sequence.epoch = state['epoch']
+
+        callbacks = [step_timing_callback(tracer, batch_size)]
+        if checkpointing:
+            callbacks.append(PeriodicCheckpoint(checkpoint_dir, [test_indices, validation_indices, train_indices],
+                                                args.checkpoint_steps, args.checkpoint_minutes,
+                                                args.keep_checkpoints, state['global_step'], state['step']))
+
+        with tracer.stage('fit', (epochs - state['epoch']) * len(train_indices) - state['step'] * batch_size):
+            histories = []
+            # shuffle=False in both calls: the sequence permutes the images per epoch itself and its batches must be
+            # requested in order, the checkpoint step only counts the batches done, so skip is only valid for a
+            # sequential batch order
+            if state['step']:
+                # finish the interrupted epoch first, skipping the batches it already trained on
+                train_sequence.skip = state['step']
+                histories.append(model.fit_generator(train_sequence,
+                                                     validation_data=(validation_images, validation_labels),
+                                                     epochs=state['epoch'] + 1,
+                                                     initial_epoch=state['epoch'],
+                                                     callbacks=callbacks,
+                                                     workers=args.workers,
+                                                     use_multiprocessing=do_augment,
+                                                     shuffle=False).history)
+                state['epoch'] += 1
+
+            if state['epoch'] < epochs:
+                # on_epoch_end of the sequence may not have run when fit_generator stopped its enqueuer
+                train_sequence.skip = 0
+                train_sequence.epoch = state['epoch']
+                histories.append(model.fit_generator(train_sequence,
+                                                     validation_data=(validation_images, validation_labels),
+                                                     epochs=epochs,
+                                                     initial_epoch=state['epoch'],
+                                                     callbacks=callbacks,
+                                                     workers=args.workers,
+                                                     use_multiprocessing=do_augment,
+                                                     shuffle=False).history)
+
+        history = {}
+        for h in histories:
+            for key, values in h.items():
+                history.setdefault(key, []).extend(values)
+        print('\nhistory:', history)
+
+        with tracer.stage('evaluate', len(test_images)):
+            eval = model.evaluate(test_images, test_labels)
+        print('\neval:', eval)
+        if args.teacher:
+            teacher_accuracy = np.mean(teacher_predictions[test_indices].argmax(axis=1) == labels[test_indices])
+            print('teacher accuracy:', teacher_accuracy)
+
+    if worker_index == 0:
+        name = datetime.now().strftime('%Y-%m-%d_%H:%M:%S') + '.h5'
+
+        print('Saving model', name)
+        with tracer.stage('save'):
+            model.save(os.path.join(path, name))
 
-    print('Saving model', name)
-    model.save(os.path.join(path, name))
+    print()
+    tracer.print_summary()
+    if args.trace:
+        tracer.save(args.trace)
+    if args.chrome_trace:
+        tracer.save_chrome_trace(args.chrome_trace)
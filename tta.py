@@ -0,0 +1,58 @@
+import numpy as np
+from process_signs import _flip_horizontally, _flip_vertically, _rotate_180, _rotate_arrows, rotate
+
+
+def _rotate(image, angle):
+    if image.ndim == 3 and image.shape[2] == 1:
+        return rotate(image[..., 0], angle)[..., np.newaxis]
+    return rotate(image, angle)
+
+
+def symmetric_views(number_of_classes, arrows=False):
+    """The test-time views as a list of (name, method, mapping), an image of class c transformed by method is an
+    image of class mapping[c], -1 where the transformed image is not a valid sign. The first view is the identity.
+
+    The views come from the same symmetry tables as the training augmentation, with arrows the arrow signs are also
+    rotated onto each other - one view per rotation angle, each of them only helps the few arrow classes."""
+    views = {'identity': (lambda image: image, np.arange(number_of_classes))}
+
+    for name, list_of_pairs, method in [('flip_horizontally', _flip_horizontally, np.fliplr),
+                                        ('flip_vertically', _flip_vertically, np.flipud),
+                                        ('rotate_180', _rotate_180, lambda image: np.rot90(image, 2))]:
+        mapping = np.full(number_of_classes, -1)
+        for first, second in list_of_pairs:
+            mapping[first], mapping[second] = second, first
+        views[name] = (method, mapping)
+
+    if arrows:
+        for first_cat, first_angle in _rotate_arrows:
+            for second_cat, second_angle in _rotate_arrows:
+                angle = (first_angle - second_angle) % 360
+                if first_cat == second_cat:
+                    continue
+
+                name = 'rotate_180' if angle == 180 else f'rotate_{angle}'
+                if name not in views:
+                    views[name] = (lambda image, angle=angle: _rotate(image, angle),
+                                   np.full(number_of_classes, -1))
+                views[name][1][first_cat] = second_cat
+
+    return [(name, method, mapping) for name, (method, mapping) in views.items()]
+
+
+def make_views(images, views):
+    """Stacks all views of a batch of uint8 images into one batch, view by view: (len(views) * N, ...)."""
+    return np.concatenate([np.stack([method(image) for image in images], axis=0) for _, method, _ in views], axis=0)
+
+
+def combine_views(predictions, views):
+    """Averages the predictions of the views made by make_views into (N, number_of_classes). The probability of
+    class c is the mean over the views that map c to a valid class of the probability of the mapped class."""
+    mappings = np.stack([mapping for _, _, mapping in views], axis=0)
+    valid = mappings >= 0
+    predictions = predictions.reshape((len(views), -1, predictions.shape[-1]))
+
+    mapped = np.stack([p[:, mapping] for p, mapping in zip(predictions, np.where(valid, mappings, 0))], axis=0)
+    combined = (mapped * valid[:, np.newaxis, :]).sum(axis=0) / valid.sum(axis=0)
+
+    return combined / combined.sum(axis=1, keepdims=True)